@@ -1,26 +1,133 @@
 from os.path import dirname, join
 
 from adapt.intent import IntentBuilder
+from mycroft.messagebus.message import Message
 from mycroft.skills.core import FallbackSkill, intent_handler
 from mycroft.util.log import getLogger
 
 from os.path import dirname, join
-from requests import get, post
-from requests.exceptions import ConnectionError
-from fuzzywuzzy import fuzz
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from ssl import CERT_NONE
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from collections import OrderedDict
+from functools import partial, wraps
+import asyncio
 import json
+import re
+import threading
+import time
+
+from .capture import TraceRecorder
+from .coalesce import SingleFlight
+from .conversation import ConversationScreen
+from .entity import Entity
+from .entity_index import EntityIndex
+from .health import CircuitBreaker
+from .metrics import Metrics
+from .multi import (SERVER_TIMEOUT, MultiStateCache, combine, parse_servers,
+                    tag_entity, tagging_capture, untag)
+from .optimistic import LightTracker
+from .projection import FetchPlanner, parse, template
+from .service_socket import ServiceSocket
+from .state_cache import StateCache
+from .streaming import CHUNK_SIZE, iter_json_array
+from .units import UnitSpeaker
 
 __author__ = 'robconnolly, btotharye, nielstron'
 LOGGER = getLogger(__name__)
 
 # Timeout time for HA requests
 TIMEOUT = 10
+# Timeout of the requests checking if a down server is back
+PROBE_TIMEOUT = 2
+# Seconds the conversation fallback waits for the server
+FALLBACK_TIMEOUT = 3
+# Number of kept-alive connections to the HA server
+POOL_SIZE = 4
+# Seconds fetched states are shared with following lookups
+FRESHNESS = 0.5
+# Seconds prefetched states wait for the lookup they were fetched for
+PREFETCH_FRESHNESS = 10
+# Minimum seconds between two prefetches
+PREFETCH_INTERVAL = 2
+# Maximum number of entity ids sent in one service call
+BATCH_SIZE = 100
+# Words asking to switch every entity of a domain (regex/*/switch.rx)
+BULK_WORDS = ['all', 'every', 'any']
+# Words separating the names of several entities in one command
+CONJUNCTIONS = ['and', 'und']
+# Score from which a whole list ("light and sound") is taken as one name
+NAME_SCORE = 85
+# Components and entities of the last run (in the skill's file system)
+SNAPSHOT_FILE = 'snapshot.json'
+# Traces of the handled intents (see capture.py)
+TRACE_FILE = 'traces.jsonl'
 
 
+def timed_intent(name, entry=None):
+    """Trace the spans of a handler and report them on the bus
+
+    Attributes:
+        name        name of the intent in the metrics
+        entry       name of the method the message is handled by (for
+                    replaying captured traces), default the decorated one
+    """
+    def decorator(func):
+        @wraps(func)
+        def handler(self, message):
+            if self.capture is not None:
+                self.capture.begin(entry or func.__name__, name,
+                                   message.data)
+            trace = None
+            try:
+                with self.metrics.trace(name) as trace:
+                    return func(self, message)
+            finally:
+                try:
+                    if trace is not None:
+                        self._report_trace(trace)
+                finally:
+                    if self.capture is not None:
+                        self.capture.end(trace)
+        return handler
+    return decorator
+
+
+def _result(future, wait):
+    """Result of future if it is done within wait seconds, else future"""
+    if wait is None:
+        return future
+    try:
+        return future.result(wait)
+    except FutureTimeout:
+        return future
+
+
+def _covers(flight_key, key):
+    """Whether fetched flight_key answers a lookup of key (SingleFlight)
+
+    Keys are ('states', domains or None for all) and ('entity', id).
+    """
+    if flight_key == key:
+        return True
+    kind, domains = flight_key
+    if kind != 'states' or domains is None:
+        return kind == 'states'
+    if key[0] == 'states':
+        return key[1] is not None and key[1] <= domains
+    return key[1].split(".")[0] in domains
+
+
 class HomeAssistantClient(object):
-    def __init__(self, host, password, portnum, ssl=False, verify=True):
+    def __init__(self, host, password, portnum, ssl=False, verify=True,
+                 pool_size=POOL_SIZE, keep_alive=True, metrics=None,
+                 freshness=FRESHNESS, websocket_services=False):
         self.ssl = ssl
         self.verify = verify
+        self.pool_size = pool_size
         if portnum is None or portnum == 0:
             portnum = 8123
         if self.ssl:
@@ -31,109 +138,523 @@ class HomeAssistantClient(object):
             'x-ha-access': password,
             'Content-Type': 'application/json'
         }
+        self.password = password
+        self._init_lookup(metrics, freshness)
+        # one session => connections (and TLS handshakes) are reused
+        self.session = Session()
+        self.session.headers.update(self.headers)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.session.verify = self.verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._adapter = adapter
+        self._request_count = 0
+        # requests fail right away while the server is known to be down
+        self.health = CircuitBreaker(self._probe)
+        # service calls pipelined over one websocket connection
+        self.services = None
+        if websocket_services and ServiceSocket.available():
+            url, sslopt = self._websocket_endpoint()
+            self.services = ServiceSocket(url, password, sslopt, TIMEOUT)
+        # all states or a projection of the wanted domains
+        self.planner = FetchPlanner()
 
-    def find_entity(self, entity, types):
+    def _init_lookup(self, metrics, freshness):
+        self.metrics = metrics or Metrics()
+        self.cache = None
+        self.index = EntityIndex()
+        # the index holds a persisted registry, not yet checked against
+        # the server (see load_registry)
+        self._registry_only = False
+        # the index holds all domains, not only those of the last lookup
+        self._index_complete = False
+        # concurrent lookups share one request
+        self._flights = SingleFlight(freshness, _covers)
+        self._prefetch_lock = threading.Lock()
+        self._prefetched = 0
+        # TraceRecorder noting lookups and service calls (see capture.py)
+        self.capture = None
+
+    @property
+    def available(self):
+        """False while the server is known to be unreachable"""
+        return self.health.available
+
+    def set_capture(self, capture):
+        """Note the entities looked up and the service calls in capture"""
+        self.capture = capture
+
+    def _probe(self):
+        try:
+            self.session.get("%s/api/" % self.url, timeout=PROBE_TIMEOUT)
+        except RequestException:
+            return False
+        # any answer will do, even 401
+        return True
+
+    def _request(self, method, path, timeout=TIMEOUT, **kwargs):
+        if not self.health.available:
+            raise ConnectionError('%s is unreachable' % self.url)
+        self._request_count += 1
+        try:
+            req = self.session.request(method, "%s%s" % (self.url, path),
+                                       timeout=timeout, **kwargs)
+        except ConnectionError as e:
+            self.health.failure(e)
+            raise
+        except Timeout as e:
+            # a shorter timeout is a latency budget, not a sign of a
+            # server being down
+            if timeout >= TIMEOUT:
+                self.health.failure(e)
+            raise
+        self.health.success()
+        return req
+
+    def _get(self, path, stream=False):
+        """GET request to the server
+
+        With stream=True only the headers are read, the body has to be
+        consumed (see _iter_content) or the response closed.
+        """
+        with self.metrics.span('fetch'):
+            req = self._request('GET', path, stream=stream)
+        if not stream:
+            self.metrics.count('bytes', len(req.content))
+        return req
+
+    def _iter_content(self, req):
+        for chunk in req.iter_content(CHUNK_SIZE):
+            self.metrics.count('bytes', len(chunk))
+            yield chunk
+
+    def _post(self, path, data, timeout=TIMEOUT):
+        body = json.dumps(data)
+        req = self._request('POST', path, timeout, data=body)
+        self.metrics.count('bytes', len(body) + len(req.content))
+        return req
+
+    def connection_stats(self):
+        """Requests sent vs. connections opened to the HA server
+
+        Return:
+            { 'requests': requests sent,
+              'connections': new connections opened,
+              'reused': requests that used a kept-alive connection,
+              'coalesced': lookups answered by another one's request,
+              'socket_calls': service calls sent over the websocket,
+              'socket_pending': of them still waiting for their result,
+              'template_fetches': states fetched as projection,
+              'fetch_plan': FetchPlanner.stats(),
+              'trips': times the server was found unreachable }
+        """
+        pools = self._adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        return {'requests': self._request_count,
+                'connections': connections,
+                'reused': max(self._request_count - connections, 0),
+                'coalesced': self._flights.shared,
+                'socket_calls': 0 if self.services is None
+                else self.services.calls,
+                'socket_pending': 0 if self.services is None
+                else self.services.pending(),
+                'template_fetches': self.planner.template_fetches,
+                'fetch_plan': self.planner.stats(),
+                'trips': self.health.trips}
+
+    def close(self):
+        self.health.close()
+        self.stop_cache()
+        if self.services is not None:
+            self.services.close()
+        self.session.close()
+
+    def start_cache(self):
+        """Keep a live copy of all entity states (HA websocket API)"""
+        if self.cache is not None or not StateCache.available():
+            return
+        self.cache = self._create_cache()
+        # the name index follows the cache instead of being rebuilt
+        self.cache.add_listener(self.index)
+        self.cache.start()
+
+    def _websocket_endpoint(self):
+        """(url, sslopt) of the websocket API"""
         if self.ssl:
-            req = get("%s/api/states" %
-                      self.url, headers=self.headers,
-                      verify=self.verify, timeout=TIMEOUT)
+            ws_url = "wss" + self.url[len("https"):] + "/api/websocket"
+            sslopt = {} if self.verify else {'cert_reqs': CERT_NONE}
         else:
-            req = get("%s/api/states" % self.url, headers=self.headers,
-                      timeout=TIMEOUT)
+            ws_url = "ws" + self.url[len("http"):] + "/api/websocket"
+            sslopt = None
+        return ws_url, sslopt
 
-        if req.status_code == 200:
-            # require a score above 50%
-            best_score = 50
-            best_entity = None
-            for state in req.json():
-                try:
-                    if state['entity_id'].split(".")[0] in types:
-                        # something like temperature outside
-                        # should score on "outside temperature sensor"
-                        # and repetitions should not count on my behalf
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['attributes']['friendly_name'].lower())
-                        if score > best_score:
-                            best_score = score
-                            best_entity = {
-                                "id": state['entity_id'],
-                                "dev_name": state['attributes']
-                                ['friendly_name'],
-                                "state": state['state']}
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['entity_id'].lower())
-                        if score > best_score:
-                            best_score = score
-                            best_entity = {
-                                "id": state['entity_id'],
-                                "dev_name": state['attributes']
-                                ['friendly_name'],
-                                "state": state['state']}
-                except KeyError:
-                    pass
-            return best_entity
-    #
-    # checking the entity attributes to be used in the response dialog.
-    #
+    def _create_cache(self):
+        ws_url, sslopt = self._websocket_endpoint()
+        return StateCache(ws_url, self.password, sslopt, TIMEOUT)
+
+    def stop_cache(self):
+        if self.cache is not None:
+            self.cache.stop()
+            self.cache = None
+
+    def _get_states(self, types=None):
+        """Entity states, from the live cache if it is in sync
+
+        Fetched states are parsed one by one while they are downloaded
+        and only kept as Entity records, so memory doesn't grow with the
+        size of all attributes. Concurrent callers share one fetch, which
+        is reused for FRESHNESS seconds.
+
+        Attributes:
+            types       list of domains to keep, None for all
+        Return:
+            list of Entity or None if the server refused the request
+        """
+        if self.cache is not None and self.cache.synced:
+            return self.cache.states(types)
+        key = ('states', None if types is None else frozenset(types))
+        fetched, states = self._flights.do(
+            key, lambda: self._fetch_states(types))
+        if states is None or fetched == key:
+            return states
+        # shared fetch of more domains
+        return [e for e in states if e.domain in types]
+
+    def prefetch(self):
+        """Fetch all states for a lookup that is about to come
+
+        The states are kept for PREFETCH_FRESHNESS seconds (or until a
+        service call), lookups in that time use them. A running or still
+        fresh fetch of all states is kept that long instead of fetching
+        again. Nothing is done if the live cache is in sync or the last
+        prefetch was less than PREFETCH_INTERVAL seconds ago.
+
+        Return:
+            True if the states were fetched or kept
+        """
+        if self.cache is not None and self.cache.synced:
+            return False
+        with self._prefetch_lock:
+            now = time.time()
+            if now - self._prefetched < PREFETCH_INTERVAL:
+                return False
+            self._prefetched = now
+        with self.metrics.span('prefetch'):
+            self._flights.do(('states', None),
+                             lambda: self._fetch_states(None),
+                             PREFETCH_FRESHNESS)
+        return True
+
+    def _fetch_states(self, types):
+        """States of the domains types, all states if types is None
+
+        Only the wanted domains are rendered by the server if that was
+        found to be cheaper (see projection.py).
+        """
+        if self.planner.use_template(types):
+            states = self._fetch_projection(types)
+            if states is not None:
+                return states
+        return self._fetch_all(types)
+
+    def _fetch_all(self, types):
+        start = time.time()
+        req = self._get("/api/states", stream=True)
+        try:
+            if req.status_code != 200:
+                return None
+            prefixes = None if types is None else tuple(
+                "%s." % domain for domain in types)
+            with self.metrics.span('parse'):
+                states = [Entity.from_state(state) for state
+                          in iter_json_array(self._iter_content(req))
+                          if prefixes is None or
+                          state['entity_id'].startswith(prefixes)]
+            self.planner.record(None, time.time() - start, req.raw.tell())
+            return states
+        finally:
+            req.close()
+
+    def _fetch_projection(self, types):
+        """States of the domains types rendered by the template API
+
+        Return:
+            list of Entity, None if the server rendered no projection
+        """
+        start = time.time()
+        with self.metrics.span('fetch'):
+            req = self._post("/api/template", {'template': template(types)})
+        if req.status_code != 200:
+            if req.status_code in (400, 404):
+                # unknown endpoint, filter or template syntax
+                LOGGER.info('No template projection: %s' % req.text)
+                self.planner.unsupported()
+            return None
+        try:
+            with self.metrics.span('parse'):
+                states = parse(req.text)
+        except ValueError as e:
+            LOGGER.info('No template projection: %s' % e)
+            self.planner.unsupported()
+            return None
+        self.planner.record(types, time.time() - start, len(req.content))
+        return states
+
+    def find_entity(self, entity, types):
+        """Find the entity best matching a spoken name
+
+        Attributes:
+            entity       spoken name of the entity
+            types        list of domains to search in
+        Return:
+            Entity (with state and attributes) or None
+        """
+        if self._registry_only and not (self.cache is not None and
+                                        self.cache.synced):
+            # names from the persisted registry, only the state of the
+            # match is fetched
+            with self.metrics.span('match'):
+                found = self.index.match(entity, types)
+            if found is not None:
+                found = self.find_entity_attr(found.id)
+                if found is not None:
+                    return found
+        if not self._refresh_index(types):
+            return None
+        # something like temperature outside
+        # should score on "outside temperature sensor"
+        # and repetitions should not count on my behalf
+        with self.metrics.span('match'):
+            return self.index.match(entity, types)
+
+    def find_entity_list(self, entities, types):
+        """Find the entities best matching several spoken names
+
+        All names are resolved against one snapshot of the states.
+
+        Attributes:
+            entities     list of spoken names
+            types        list of domains to search in
+        Return:
+            list of Entity (None for names without a match) or None if
+            the states couldn't be fetched
+        """
+        if not self._refresh_index(types):
+            return None
+        with self.metrics.span('match'):
+            return [self.index.match(entity, types) for entity in entities]
+
+    def find_entities(self, types):
+        """All entities of the given domains (from one snapshot)
+
+        Return:
+            list of Entity or None if the states couldn't be fetched
+        """
+        if not self._refresh_index(types):
+            return None
+        return self.index.entities(types)
+
+    def _refresh_index(self, types):
+        """Make sure the name index reflects the current states
+
+        Without the live cache the entities of the requested domains are
+        replaced with a fresh snapshot of them. Only those domains are
+        touched, lookups of other domains may run at the same time.
+        """
+        if self.cache is None or not self.cache.synced:
+            # a fresh snapshot, index it before matching
+            states = self._get_states(types)
+            if states is None:
+                return False
+            with self.metrics.span('index'):
+                self.index.replace(states, types)
+            self._registry_only = False
+        if self.capture is not None:
+            self.capture.saw(self.index.entities(types))
+        self.metrics.count('entities', len(self.index))
+        return True
+
+    def load_registry(self, states):
+        """Index entities known from an earlier run
+
+        Spoken names can be matched right away, before the server
+        answered. Until the index is refreshed from the server (see
+        registry) find_entity fetches the state of the match by its id.
+
+        Attributes:
+            states      list of state dicts (as from Entity.as_state)
+        """
+        with self.metrics.span('index'):
+            self.index.rebuild(Entity.from_state(s) for s in states)
+        self._registry_only = True
+        self._index_complete = True
+
+    def registry(self):
+        """Current states of all entities, to be persisted
+
+        Waits for the live cache if there is one, otherwise all states
+        are fetched and indexed.
+
+        Return:
+            list of Entity or None
+        """
+        if self.cache is not None and self.cache.wait_synced(TIMEOUT):
+            self._registry_only = False
+            return self.cache.states()
+        states = self._get_states()
+        if states is not None:
+            with self.metrics.span('index'):
+                self.index.rebuild(states)
+            self._registry_only = False
+            self._index_complete = True
+        return states
+
+    @property
+    def index_complete(self):
+        """True if the name index holds the entities of all domains"""
+        return ((self.cache is not None and self.cache.synced) or
+                self._index_complete)
 
     def find_entity_attr(self, entity):
-        if self.ssl:
-            req = get("%s/api/states" %
-                      self.url, headers=self.headers, verify=self.verify,
-                      timeout=TIMEOUT)
+        """Current state and attributes of an entity
+
+        Attributes:
+            entity       entity id, e.g. light.kitchen
+        Return:
+            Entity or None if the server doesn't know the entity
+        """
+        if self.cache is not None and self.cache.synced:
+            state = self.cache.get(entity)
         else:
-            req = get("%s/api/states" % self.url, headers=self.headers,
-                      timeout=TIMEOUT)
+            fetched, state = self._flights.do(
+                ('entity', entity), lambda: self._fetch_state(entity))
+            if fetched[0] == 'states' and state is not None:
+                # answered by a fetch of all states of the domain (None
+                # if the server refused it)
+                state = next((e for e in state if e.id == entity), None)
+        if self.capture is not None and state is not None:
+            self.capture.saw([state])
+        return state
 
+    def _fetch_state(self, entity):
+        req = self._get("/api/states/%s" % entity)
         if req.status_code == 200:
-            for attr in req.json():
-                if attr['entity_id'] == entity:
-                    entity_attrs = attr['attributes']
-                    try:
-                        if attr['entity_id'].startswith('light.'):
-                            # Not all lamps do have a color
-                            unit_measur = entity_attrs['brightness']
-                        else:
-                            unit_measur = entity_attrs['unit_of_measurement']
-                    except KeyError:
-                        unit_measur = None
-                    # IDEA: return the color if available
-                    # TODO: change to return the whole attr dictionary =>
-                    # free use within handle methods
-                    sensor_name = entity_attrs['friendly_name']
-                    sensor_state = attr['state']
-                    return unit_measur, sensor_name, sensor_state
-        return None
+            return Entity.from_state(req.json())
 
-    def execute_service(self, domain, service, data):
-        if self.ssl:
-            post("%s/api/services/%s/%s" % (self.url, domain, service),
-                 headers=self.headers, data=json.dumps(data),
-                 verify=self.verify, timeout=TIMEOUT)
-        else:
-            post("%s/api/services/%s/%s" % (self.url, domain, service),
-                 headers=self.headers, data=json.dumps(data), timeout=TIMEOUT)
+    def execute_service(self, domain, service, data, on_error=None,
+                        wait=None):
+        """Call a service of the HA-Server
 
-    def find_component(self, component):
-        """Check if a component is loaded at the HA-Server"""
-        if self.ssl:
-            req = get("%s/api/components" %
-                      self.url, headers=self.headers, verify=self.verify,
-                      timeout=TIMEOUT)
+        Attributes:
+            domain, service  service to call, e.g. light, turn_on
+            data             service data (dict)
+            on_error         called with the exception if the call fails,
+                             if not given the exception is raised
+            wait             seconds to wait for the result of a call
+                             that doesn't block (websocket, async client),
+                             None to return right away
+        Return:
+            True if the server accepted the call, or a Future of that if
+            the result wasn't awaited
+        """
+        if self.capture is not None:
+            self.capture.call(domain, service, data)
+        if self.services is not None:
+            return self._call_socket(domain, service, data, on_error, wait)
+        try:
+            with self.metrics.span('service'):
+                req = self._post("/api/services/%s/%s" % (domain, service),
+                                 data)
+            req.raise_for_status()
+        except RequestException as e:
+            if on_error is None:
+                raise
+            on_error(e)
+            return False
+        # states fetched before are outdated now
+        self._flights.forget()
+        return True
+
+    def _call_socket(self, domain, service, data, on_error, wait):
+        """execute_service over the websocket connection"""
+        if self.health.available:
+            future = self.services.call(domain, service, data)
         else:
-            req = get("%s/api/components" % self.url, headers=self.headers,
-                      timeout=TIMEOUT)
+            future = Future()
+            future.set_exception(
+                ConnectionError('%s is unreachable' % self.url))
+        # states fetched before are outdated now
+        self._flights.forget()
+        future.add_done_callback(partial(self._socket_done, on_error,
+                                         wait is None))
+        with self.metrics.span('service'):
+            try:
+                return _result(future, wait)
+            except RequestException:
+                if on_error is None:
+                    raise
+                # on_error was told by _socket_done
+                return False
+
+    def _socket_done(self, on_error, detached, future):
+        error = future.exception()
+        if error is None:
+            self.health.success()
+            return
+        if isinstance(error, ConnectionError):
+            self.health.failure(error)
+        if on_error is not None:
+            on_error(error)
+        elif detached:
+            # nobody waits for this call
+            LOGGER.error('Service call failed: %s' % error)
 
+    def _batches(self, entity_ids, data):
+        for i in range(0, len(entity_ids), BATCH_SIZE):
+            yield dict(data or {}, entity_id=entity_ids[i:i + BATCH_SIZE])
+
+    def execute_service_batch(self, domain, service, entity_ids, data=None,
+                              on_error=None):
+        """Call a service for many entities with as few requests as possible
+
+        Services like homeassistant.turn_on take a list of entity ids.
+        Longer lists are split into batches of BATCH_SIZE which are sent
+        in parallel.
+
+        Return:
+            list of the execute_service results, one per batch
+        """
+        batches = list(self._batches(entity_ids, data))
+        if len(batches) <= 1 or self.services is not None:
+            # websocket calls are pipelined anyway
+            return [self.execute_service(domain, service, batch, on_error)
+                    for batch in batches]
+        with ThreadPoolExecutor(self.pool_size) as executor:
+            return list(executor.map(
+                lambda batch: self.execute_service(domain, service, batch,
+                                                   on_error),
+                batches))
+
+    def find_components(self):
+        """Components loaded at the HA-Server (list or None)"""
+        req = self._get("/api/components")
         if req.status_code == 200:
-            return component in req.json()
+            return req.json()
 
-    def engage_conversation(self, utterance):
+    def find_component(self, component):
+        """Check if a component is loaded at the HA-Server"""
+        components = self.find_components()
+        if components is not None:
+            return component in components
+
+    def engage_conversation(self, utterance, timeout=TIMEOUT):
         """Engage the conversation component at the Home Assistant server
 
         Attributes:
             utterance    raw text message to be processed
+            timeout      seconds to wait for the answer
         Return:
             Dict answer by Home Assistant server
             { 'speech': textual answer,
@@ -142,19 +663,225 @@ class HomeAssistantClient(object):
         data = {
              "text": utterance
              }
-        if self.ssl:
-            return post("%s/api/conversation/process" % (self.url),
-                        headers=self.headers,
-                        data=json.dumps(data),
-                        verify=self.verify,
-                        timeout=TIMEOUT
-                        ).json()['speech']['plain']
+        with self.metrics.span('conversation'):
+            req = self._post("/api/conversation/process", data, timeout)
+        return req.json()['speech']['plain']
+
+
+class AsyncHomeAssistantClient(HomeAssistantClient):
+    """HomeAssistantClient not waiting for service calls
+
+    Service calls are run on a background asyncio event loop and
+    execute_service returns a concurrent.futures.Future right away.
+    Failures are passed to on_error (on the loop thread).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncHomeAssistantClient, self).__init__(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        # not more parallel calls than kept-alive connections
+        self.loop.set_default_executor(ThreadPoolExecutor(self.pool_size))
+        self._loop_thread = threading.Thread(
+            target=self._run_loop, name='HomeAssistantClientLoop')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _execute_service(self, domain, service, data, on_error):
+        # requests blocks, the executor keeps the loop free meanwhile
+        call = super(AsyncHomeAssistantClient, self).execute_service
+        try:
+            return await self.loop.run_in_executor(
+                None, call, domain, service, data, on_error)
+        except Exception as e:
+            LOGGER.exception('Service call %s.%s failed' %
+                             (domain, service))
+            if on_error is not None:
+                on_error(e)
+            return False
+
+    def execute_service(self, domain, service, data, on_error=None,
+                        wait=None):
+        if self.services is not None:
+            # websocket calls don't block, no need for the loop
+            return super(AsyncHomeAssistantClient, self).execute_service(
+                domain, service, data, on_error, wait)
+        return _result(asyncio.run_coroutine_threadsafe(
+            self._execute_service(domain, service, data, on_error),
+            self.loop), wait)
+
+    def execute_service_batch(self, domain, service, entity_ids, data=None,
+                              on_error=None):
+        # the loop already runs the batches in parallel
+        return [self.execute_service(domain, service, batch, on_error)
+                for batch in self._batches(entity_ids, data)]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(TIMEOUT)
+        super(AsyncHomeAssistantClient, self).close()
+
+
+class MultiHomeAssistantClient(HomeAssistantClient):
+    """Several Home Assistant servers behind one client
+
+    The entities of all servers are resolved in one index, ids of the
+    additional servers are tagged with their name (see multi.py).
+    States are fetched from all servers in parallel and service calls
+    are sent to the server owning the entity.
+
+    Attributes:
+        clients     list of (server name, HomeAssistantClient), the
+                    first one is the primary server with name None
+        timeouts    seconds to wait for the states of a server (by name),
+                    the primary one has the usual TIMEOUT
+    """
+
+    def __init__(self, clients, timeouts=None, metrics=None,
+                 freshness=FRESHNESS):
+        self.clients = clients
+        self.timeouts = timeouts or {}
+        self._by_origin = dict(clients)
+        self.url = " ".join(client.url for _, client in clients)
+        self._init_lookup(metrics, freshness)
+        self._executor = ThreadPoolExecutor(len(clients))
+
+    @property
+    def primary(self):
+        return self.clients[0][1]
+
+    @property
+    def available(self):
+        return any(client.available for _, client in self.clients)
+
+    def set_capture(self, capture):
+        # the index holds the tagged ids already
+        self.capture = capture
+        for origin, client in self.clients:
+            client.set_capture(tagging_capture(capture, origin))
+
+    def connection_stats(self):
+        stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                 'socket_calls': 0, 'socket_pending': 0,
+                 'template_fetches': 0, 'trips': 0}
+        plans = {}
+        for origin, client in self.clients:
+            client_stats = client.connection_stats()
+            for key in stats:
+                stats[key] += client_stats[key]
+            plans[origin or 'primary'] = client_stats['fetch_plan']
+        stats['coalesced'] = self._flights.shared
+        # fetches are planned per server
+        stats['fetch_plan'] = plans
+        return stats
+
+    def close(self):
+        self.stop_cache()
+        for _, client in self.clients:
+            client.close()
+        self._executor.shutdown(wait=False)
+
+    def _create_cache(self):
+        return MultiStateCache([(origin, client._create_cache())
+                                for origin, client in self.clients])
+
+    def _client(self, origin):
+        client = self._by_origin.get(origin)
+        if client is None:
+            raise ValueError('Unknown Home Assistant server %s' % origin)
+        return client
+
+    def _fetch_states(self, types):
+        """States of all servers, not waiting for late ones"""
+        start = time.time()
+        futures = [(origin, self._executor.submit(client._fetch_states,
+                                                  types))
+                   for origin, client in self.clients]
+        states = []
+        answered = False
+        missing = []
+        late = set()
+        for origin, future in futures:
+            timeout = self.timeouts.get(origin, SERVER_TIMEOUT)
+            if origin is None:
+                timeout = TIMEOUT
+            try:
+                result = future.result(max(start + timeout - time.time(),
+                                           0))
+            except (FutureTimeout, RequestException) as e:
+                LOGGER.warning('No states of Home Assistant %s: %r' %
+                               (origin or 'primary', e))
+                missing.append(e)
+                late.add(origin)
+                continue
+            if result is not None:
+                answered = True
+                states.extend(tag_entity(e, origin) for e in result)
+            else:
+                late.add(origin)
+        if not answered and missing:
+            raise ConnectionError('No Home Assistant server answered')
+        if answered and late:
+            # the entities of the other servers as last known, so their
+            # names don't resolve to a device of an answering server
+            domains = types if types is not None else self.index.domains()
+            states.extend(e for e in self.index.entities(domains)
+                          if untag(e.id)[1] in late)
+        return states if answered else None
+
+    def _fetch_state(self, entity):
+        entity_id, origin = untag(entity)
+        return tag_entity(self._client(origin)._fetch_state(entity_id),
+                          origin)
+
+    def _route(self, entity_ids):
+        """Entity ids (untagged) by the name of their server"""
+        routes = OrderedDict()
+        for entity_id in entity_ids:
+            entity_id, origin = untag(entity_id)
+            routes.setdefault(origin, []).append(entity_id)
+        return routes
+
+    def execute_service(self, domain, service, data, on_error=None,
+                        wait=None):
+        entity_ids = data.get('entity_id')
+        if entity_ids is None:
+            results = [self.primary.execute_service(domain, service, data,
+                                                    on_error, wait)]
         else:
-            return post("%s/api/conversation/process" % (self.url),
-                        headers=self.headers,
-                        data=json.dumps(data),
-                        timeout=TIMEOUT
-                        ).json()['speech']['plain']
+            single = not isinstance(entity_ids, list)
+            calls = [(self._client(origin).execute_service, domain, service,
+                      dict(data, entity_id=ids[0] if single else ids),
+                      on_error, wait)
+                     for origin, ids in self._route(
+                         [entity_ids] if single else entity_ids).items()]
+            if len(calls) == 1:
+                results = [calls[0][0](*calls[0][1:])]
+            else:
+                # the servers are called at the same time
+                with ThreadPoolExecutor(len(calls)) as executor:
+                    results = list(executor.map(
+                        lambda call: call[0](*call[1:]), calls))
+        self._flights.forget()
+        return results[0] if len(results) == 1 else combine(results)
+
+    def execute_service_batch(self, domain, service, entity_ids, data=None,
+                              on_error=None):
+        results = []
+        for origin, ids in self._route(entity_ids).items():
+            results.extend(self._client(origin).execute_service_batch(
+                domain, service, ids, data, on_error))
+        self._flights.forget()
+        return results
+
+    def find_components(self):
+        return self.primary.find_components()
+
+    def engage_conversation(self, utterance, timeout=TIMEOUT):
+        return self.primary.engage_conversation(utterance, timeout)
 
 
 class HomeAssistantSkill(FallbackSkill):
@@ -163,6 +890,14 @@ class HomeAssistantSkill(FallbackSkill):
         super(HomeAssistantSkill, self).__init__(name="HomeAssistantSkill")
         self.ha = None
         self.enable_fallback = False
+        self.components = []
+        self.screen = ConversationScreen()
+        self.metrics = Metrics()
+        # brightness commands in flight, adjustments build on them
+        self.lights = LightTracker(self._send_brightness)
+        self.units = UnitSpeaker()
+        # records the handled intents if capture_traces is set
+        self.capture = None
         self._setup()
         try:
             self.settings.set_changed_callback(self._force_setup)
@@ -172,39 +907,282 @@ class HomeAssistantSkill(FallbackSkill):
 
     def _setup(self, force=False):
         if self.settings is not None and (force or self.ha is None):
-            self.ha = HomeAssistantClient(
+            self.lights.close()
+            if self.ha is not None:
+                self.ha.close()
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+            if self.settings.get('async_services') != 'false':
+                # handlers confirm right away, failures are told later
+                client = AsyncHomeAssistantClient
+            else:
+                client = HomeAssistantClient
+            freshness = self._number_setting('states_freshness', FRESHNESS)
+            # service calls over the websocket learn their result
+            sockets = self.settings.get('websocket_services') == 'true'
+            self.ha = client(
                 self.settings.get('host'),
                 self.settings.get('password'),
                 int(self.settings.get('portnum')),
                 self.settings.get('ssl') == 'true',
-                self.settings.get('verify') == 'true'
+                self.settings.get('verify') == 'true',
+                metrics=self.metrics,
+                freshness=freshness,
+                websocket_services=sockets
                 )
-            if self.ha:
-                # Check if conversation component is loaded at HA-server
-                # and activate fallback accordingly (ha-server/api/components)
-                # TODO: enable other tools like dialogflow
-                if (self.ha.find_component('conversation') and
-                   self.settings.get('enable_fallback') == 'true'):
-                    self.enable_fallback = True
+            try:
+                servers = parse_servers(self.settings.get('extra_servers'))
+            except ValueError as e:
+                LOGGER.error(e)
+                servers = []
+            if servers:
+                # the primary server and the additional ones
+                self.ha = MultiHomeAssistantClient(
+                    [(None, self.ha)] + [(server['name'], client(
+                        server['host'], server['password'], server['port'],
+                        server['ssl'], self.settings.get('verify') == 'true',
+                        metrics=self.metrics, websocket_services=sockets))
+                     for server in servers],
+                    dict((server['name'], server['timeout'])
+                         for server in servers),
+                    metrics=self.metrics, freshness=freshness)
+            if self.settings.get('capture_traces') == 'true':
+                # what the intents saw and did, for benchmarks/replay.py
+                self.capture = TraceRecorder(
+                    partial(self.file_system.open, TRACE_FILE),
+                    [self.settings.get('password')] +
+                    [server['password'] for server in servers])
+                primary = getattr(self.ha, 'primary', self.ha)
+                self.capture.server(primary.url, primary.headers)
+                self.ha.set_capture(self.capture)
+            # ready with what the last run knew, the server is asked in
+            # the background so a slow or offline server doesn't block
+            # loading the skill
+            self._load_snapshot()
+            if self.settings.get('enable_cache') != 'false':
+                # entity lookups are served from memory once synced
+                self.ha.start_cache()
+                if self.ha.cache is not None:
+                    self.ha.cache.add_listener(self.lights)
+            thread = threading.Thread(target=self._revalidate,
+                                      args=(self.ha,),
+                                      name='HomeAssistantSetup')
+            thread.daemon = True
+            thread.start()
+
+    def _number_setting(self, name, default):
+        try:
+            return float(self.settings.get(name))
+        except (TypeError, ValueError):
+            return default
+
+    def _update_fallback(self, components):
+        # Check if conversation component is loaded at HA-server
+        # and activate fallback accordingly (ha-server/api/components)
+        # TODO: enable other tools like dialogflow
+        self.components = components
+        self.enable_fallback = (
+            'conversation' in components and
+            self.settings.get('enable_fallback') == 'true')
+
+    def _load_snapshot(self):
+        """Components and entities persisted by an earlier run"""
+        try:
+            if not self.file_system.exists(SNAPSHOT_FILE):
+                return
+            with self.file_system.open(SNAPSHOT_FILE, 'r') as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError) as e:
+            LOGGER.warning('Could not read %s: %s' % (SNAPSHOT_FILE, e))
+            return
+        if snapshot.get('url') != self.ha.url:
+            # taken from another server
+            return
+        self._update_fallback(snapshot.get('components', []))
+        self.ha.load_registry(snapshot.get('states', []))
+
+    def _revalidate(self, client):
+        """Ask the server for its components and entities and persist them
+
+        Attributes:
+            client      the HomeAssistantClient created by _setup
+        """
+        try:
+            components = client.find_components()
+            states = client.registry()
+        except RequestException as e:
+            LOGGER.warning('Home Assistant not reachable: %s' % e)
+            return
+        if client is not self.ha:
+            # settings changed in the meantime
+            return
+        if components is not None:
+            self._update_fallback(components)
+        if components is None or states is None:
+            return
+        try:
+            with self.file_system.open(SNAPSHOT_FILE, 'w') as f:
+                json.dump({'url': client.url,
+                           'components': components,
+                           'states': [e.as_state() for e in states]}, f)
+        except IOError as e:
+            LOGGER.warning('Could not write %s: %s' % (SNAPSHOT_FILE, e))
 
     def _force_setup(self):
         LOGGER.debug('Creating a new HomeAssistant-Client')
         self._setup(True)
 
+    @staticmethod
+    def _split_names(entity):
+        """Names listed in entity, e.g. 'the kitchen light and the fan'"""
+        names = re.split(r'\s*(?:,|\b(?:%s)\b)\s*' % '|'.join(CONJUNCTIONS),
+                         entity)
+        return [name for name in names if name]
+
+    def _join_names(self, names):
+        """Names to be spoken as one, e.g. 'kitchen light and fan'"""
+        if len(names) == 1:
+            return names[0]
+        return '%s %s %s' % (', '.join(names[:-1]),
+                             self.translate('homeassistant.and'), names[-1])
+
+    def _find_targets(self, entity, types):
+        """Find the entities named in the Entity of a message
+
+        Several names ("the kitchen light and the fan") are resolved
+        against one snapshot of the states, unless the whole text is
+        the name of an entity ("light and sound").
+
+        Return:
+            (list of Entity, list of the names that weren't found)
+        """
+        names = self._split_names(entity)
+        if len(names) == 1:
+            ha_entity = self.ha.find_entity(entity, types)
+            return ([], [entity]) if ha_entity is None else ([ha_entity], [])
+        found = self.ha.find_entity_list(names, types)
+        if found is None:
+            return [], [entity]
+        # the index holds the snapshot the names were resolved against
+        # (or a newer one of the same domains)
+        ha_entity = self.ha.index.match(entity, types, NAME_SCORE)
+        if ha_entity is not None:
+            return [ha_entity], []
+        return (self._unique(e for e in found if e is not None),
+                [n for n, e in zip(names, found) if e is None])
+
+    @staticmethod
+    def _unique(ha_entities):
+        """ha_entities without repeated entities, in their order"""
+        return list(OrderedDict((e.id, e) for e in ha_entities).values())
+
+    @staticmethod
+    def _entity_ids(ha_entities):
+        """entity_id of the service data for ha_entities"""
+        if len(ha_entities) == 1:
+            return ha_entities[0].id
+        return [e.id for e in ha_entities]
+
+    def _dispatch(self, calls):
+        """Run the service calls (functions) at the same time
+
+        Together they take as long as the slowest one, not the sum.
+        """
+        if len(calls) == 1:
+            calls[0]()
+            return
+        with ThreadPoolExecutor(len(calls)) as executor:
+            for call in calls:
+                executor.submit(call)
+
+    def _send_brightness(self, entity_id, data, on_error):
+        self.ha.execute_service("homeassistant", "turn_on", data, on_error)
+
+    def _on_service_error(self, dev_name):
+        """Callback telling the user that a service call went wrong
+
+        The handlers confirm before the call is done (it may still run
+        in the background), so a failure has to be told afterwards.
+        """
+        def on_error(error):
+            LOGGER.error("Service call for %s failed: %s" %
+                         (dev_name, error))
+            if isinstance(error, ConnectionError):
+                self.speak_dialog('homeassistant.error.offline')
+            else:
+                self.speak_dialog('homeassistant.error.service',
+                                  data={"dev_name": dev_name})
+        return on_error
+
     def initialize(self):
         self.language = self.config_core.get('lang')
         self.load_vocab_files(join(dirname(__file__), 'vocab', self.lang))
         self.load_regex_files(join(dirname(__file__), 'regex', self.lang))
         # Needs higher priority than general fallback skills
         self.register_fallback(self.handle_fallback, 2)
+        self.add_event('homeassistant.metrics.request',
+                       self.handle_metrics_request)
+        # fetch the states while the user is still talking
+        self.add_event('recognizer_loop:record_begin', self.handle_prefetch)
+        self.add_event('recognizer_loop:utterance', self.handle_prefetch)
+        if self.settings.get('preload_units') != 'false':
+            # the first sensor readout shouldn't wait for quantulum
+            self.units.warm()
+
+    def handle_prefetch(self, message):
+        """Refresh the states an intent will likely ask for soon"""
+        if (self.ha is None or not self.ha.available or
+                self.settings.get('prefetch_states') == 'false'):
+            return
+        thread = threading.Thread(target=self._prefetch, args=(self.ha,),
+                                  name='HomeAssistantPrefetch')
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch(self, client):
+        try:
+            client.prefetch()
+        except RequestException as e:
+            LOGGER.debug('Prefetching states failed: %s' % e)
+
+    def _report_trace(self, trace):
+        """Log the timings of a handled intent and put them on the bus"""
+        LOGGER.info("Timings %s" % trace)
+        if self.emitter is not None:
+            self.emitter.emit(Message('homeassistant.metrics',
+                                      trace.as_dict()))
+
+    def speak_dialog(self, key, data=None, expect_response=False):
+        if self.capture is not None:
+            self.capture.spoke(key, data)
+        super(HomeAssistantSkill, self).speak_dialog(key, data,
+                                                     expect_response)
+
+    def handle_metrics_request(self, message):
+        """Answer with the percentiles of all recorded stages"""
+        data = {'stages': self.metrics.summary(),
+                # brightness changes sent only as part of a later one
+                'coalesced_brightness': self.lights.coalesced}
+        if self.ha is not None:
+            # how often spoken names were resolved without matching
+            data['entity_memo'] = self.ha.index.memo_stats()
+            data['connections'] = self.ha.connection_stats()
+        self.emitter.emit(message.reply('homeassistant.metrics.response',
+                                        data))
 
     @intent_handler(IntentBuilder("switchIntent").require(
         "SwitchActionKeyword").require("Action").require("Entity").build())
+    @timed_intent('switch')
     def handle_switch_intent(self, message):
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            # known to be down, don't wait for a timeout
+            self.speak_dialog('homeassistant.error.offline')
+            return
         LOGGER.debug("Starting Switch Intent")
         entity = message.data["Entity"]
         action = message.data["Action"]
@@ -225,54 +1203,138 @@ class HomeAssistantSkill(FallbackSkill):
         else:
             # scenes etc can't be toggled or turned off
             domains = ['group', 'light', 'fan', 'switch', 'input_boolean']
-        # TODO if entity is 'all', 'any' or 'every' turn on
+        # if entity is 'all', 'any' or 'every' switch
         # every single entity not the whole group
+        bulk_domain = self._bulk_domain(entity, message.data.get('Domain'))
+        if bulk_domain is not None:
+            self._switch_all(bulk_domain, action,
+                             message.data.get('Domain') or
+                             entity.split(None, 1)[-1])
+            return
         try:
-            ha_entity = self.ha.find_entity(
-                entity, domains)
+            ha_entities, missing = self._find_targets(entity, domains)
         except ConnectionError:
             self.speak_dialog('homeassistant.error.offline')
             return
-        if ha_entity is None:
+        if missing:
             self.speak_dialog('homeassistant.device.unknown', data={
-                              "dev_name": entity})
+                              "dev_name": self._join_names(missing)})
+        if not ha_entities:
+            return
+        if action not in ["on", "off", "toggle"]:
+            self.speak_dialog('homeassistant.error.sorry')
             return
-        LOGGER.debug("Entity State: %s" % ha_entity['state'])
-        ha_data = {'entity_id': ha_entity['id']}
 
         # IDEA: set context for 'turn it off' again or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # self.set_context('Entity', ha_entity.dev_name)
 
-        if ha_entity['state'] == action:
-            LOGGER.debug("Entity in requested state")
-            self.speak_dialog('homeassistant.device.already', data={
-                "dev_name": ha_entity['dev_name'], 'action': action})
-        elif action == "toggle":
-            self.ha.execute_service("homeassistant", "toggle",
-                                    ha_data)
-            if(ha_entity['state'] == 'off'):
-                new_state = 'on'
+        already = []
+        # new state => entities switched to it
+        switched = OrderedDict()
+        for ha_entity in ha_entities:
+            # what it will be once our last commands are through
+            ha_entity = self.lights.predict(ha_entity)
+            LOGGER.debug("Entity State: %s" % ha_entity.state)
+            if ha_entity.state == action:
+                LOGGER.debug("Entity in requested state")
+                already.append(ha_entity)
+            elif action == "toggle":
+                if(ha_entity.state == 'off'):
+                    new_state = 'on'
+                else:
+                    new_state = 'off'
+                switched.setdefault(new_state, []).append(ha_entity)
             else:
-                new_state = 'off'
+                switched.setdefault(action, []).append(ha_entity)
+        if already:
+            self.speak_dialog('homeassistant.device.already', data={
+                "dev_name": self._join_names([e.dev_name for e in already]),
+                'action': action})
+        for new_state, targets in switched.items():
             self.speak_dialog('homeassistant.device.%s' % new_state,
-                              data=ha_entity)
-        elif action in ["on", "off"]:
-            self.ha.execute_service("homeassistant", "turn_%s" % action,
-                                    ha_data)
-            self.speak_dialog('homeassistant.device.%s' % action,
-                              data=ha_entity)
+                              data={"dev_name": self._join_names(
+                                  [e.dev_name for e in targets])})
+        targets = [e for group in switched.values() for e in group]
+        if not targets:
+            return
+        service = "toggle" if action == "toggle" else "turn_%s" % action
+        # one call switches all of them
+        self.ha.execute_service("homeassistant", service,
+                                {'entity_id': self._entity_ids(targets)},
+                                self._on_service_error(self._join_names(
+                                    [e.dev_name for e in targets])))
+        for new_state, group in switched.items():
+            for ha_entity in group:
+                if ha_entity.domain == 'light':
+                    self.lights.expect(ha_entity.id, new_state)
+
+    @staticmethod
+    def _bulk_domain(entity, domain):
+        """Domain meant by 'all lights' or similar, None if not a bulk action
+
+        Attributes:
+            entity       Entity of the message, e.g. 'all' or 'all lights'
+            domain       Domain of the message (regex/*/switch.rx), if any
+        """
+        words = entity.lower().split()
+        if not words or words[0] not in BULK_WORDS:
+            return None
+        spoken = (domain or ' '.join(words[1:])).lower()
+        if spoken.startswith('light'):
+            return 'light'
+        if spoken.startswith('switch'):
+            return 'switch'
+        if spoken.startswith('fan'):
+            return 'fan'
+        if 'input' in spoken or 'boolean' in spoken:
+            return 'input_boolean'
+        return None
+
+    def _switch_all(self, domain, action, spoken_domain):
+        """Switch every entity of a domain with as few calls as possible"""
+        try:
+            ha_entities = self.ha.find_entities([domain])
+        except ConnectionError:
+            self.speak_dialog('homeassistant.error.offline')
+            return
+        if not ha_entities:
+            self.speak_dialog('homeassistant.device.unknown', data={
+                              "dev_name": spoken_domain})
+            return
+        if action in ["on", "off"]:
+            service = "turn_%s" % action
+            # don't bother the server with entities already switched
+            targets = [e.id for e in ha_entities if e.state != action]
+        elif action == "toggle":
+            service = "toggle"
+            targets = [e.id for e in ha_entities]
         else:
             self.speak_dialog('homeassistant.error.sorry')
             return
+        LOGGER.debug("Switching %d of %d %s entities" %
+                     (len(targets), len(ha_entities), domain))
+        if not targets:
+            self.speak_dialog('homeassistant.bulk.already', data={
+                "domain": spoken_domain, 'action': action})
+            return
+        self.speak_dialog('homeassistant.bulk.%s' % action,
+                          data={"domain": spoken_domain})
+        self.ha.execute_service_batch("homeassistant", service, targets,
+                                      on_error=self._on_service_error(
+                                          spoken_domain))
 
     @intent_handler(IntentBuilder("LightSetBrightnessIntent").optionally(
         "LightsKeyword").require("SetVerb").require("Entity").require(
             "BrightnessValue").build())
+    @timed_intent('light_set')
     def handle_light_set_intent(self, message):
         self._setup()
         if(self.ha is None):
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            self.speak_dialog('homeassistant.error.offline')
+            return
         entity = message.data["Entity"]
         try:
             brightness_req = float(message.data["BrightnessValue"])
@@ -286,27 +1348,34 @@ class HomeAssistantSkill(FallbackSkill):
         LOGGER.debug("Brightness Value: %s" % brightness_value)
         LOGGER.debug("Brightness Percent: %s" % brightness_percentage)
         try:
-            ha_entity = self.ha.find_entity(
+            ha_entities, missing = self._find_targets(
                 entity, ['group', 'light'])
         except ConnectionError:
             self.speak_dialog('homeassistant.error.offline')
             return
-        if ha_entity is None:
+        if missing:
             self.speak_dialog('homeassistant.device.unknown', data={
-                              "dev_name": entity})
+                              "dev_name": self._join_names(missing)})
+        if not ha_entities:
             return
-        ha_data = {'entity_id': ha_entity['id']}
+        dev_name = self._join_names([e.dev_name for e in ha_entities])
+        ha_data = {'entity_id': self._entity_ids(ha_entities)}
 
         # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # self.set_context('Entity', ha_entity.dev_name)
 
         # TODO - Allow value set
         if "SetVerb" in message.data:
             ha_data['brightness'] = brightness_value
-            ha_data['dev_name'] = ha_entity['dev_name']
-            self.ha.execute_service("homeassistant", "turn_on", ha_data)
+            ha_data['dev_name'] = dev_name
             self.speak_dialog('homeassistant.brightness.dimmed',
                               data=ha_data)
+            self.ha.execute_service("homeassistant", "turn_on", ha_data,
+                                    self._on_service_error(dev_name))
+            for ha_entity in ha_entities:
+                self.lights.expect(ha_entity.id,
+                                   'on' if brightness_value else 'off',
+                                   brightness_value or None)
         else:
             self.speak_dialog('homeassistant.error.sorry')
             return
@@ -316,11 +1385,15 @@ class HomeAssistantSkill(FallbackSkill):
             "IncreaseVerb", "DecreaseVerb", "LightBrightenVerb",
             "LightDimVerb").require("Entity").optionally(
                 "BrightnessValue").build())
+    @timed_intent('light_adjust')
     def handle_light_adjust_intent(self, message):
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            self.speak_dialog('homeassistant.error.offline')
+            return
         entity = message.data["Entity"]
         try:
             brightness_req = float(message.data["BrightnessValue"])
@@ -342,9 +1415,11 @@ class HomeAssistantSkill(FallbackSkill):
             self.speak_dialog('homeassistant.device.unknown', data={
                               "dev_name": entity})
             return
-        ha_data = {'entity_id': ha_entity['id']}
+        # the server may not know about our last adjustment yet
+        ha_entity = self.lights.predict(ha_entity)
+        ha_data = {'entity_id': ha_entity.id}
         # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # self.set_context('Entity', ha_entity.dev_name)
 
         # if self.language == 'de':
         #    if action == 'runter' or action == 'dunkler':
@@ -353,103 +1428,115 @@ class HomeAssistantSkill(FallbackSkill):
         #        action = 'brighten'
         if "DecreaseVerb" in message.data or \
                 "LightDimVerb" in message.data:
-            if ha_entity['state'] == "off":
+            if ha_entity.state == "off":
                 self.speak_dialog('homeassistant.brightness.cantdim.off',
-                                  data=ha_entity)
+                                  data={"dev_name": ha_entity.dev_name})
+            elif ha_entity.brightness is None:
+                self.speak_dialog(
+                    'homeassistant.brightness.cantdim.dimmable',
+                    data={"dev_name": ha_entity.dev_name})
             else:
-                light_attrs = self.ha.find_entity_attr(ha_entity['id'])
-                if light_attrs[0] is None:
-                    self.speak_dialog(
-                        'homeassistant.brightness.cantdim.dimmable',
-                        data=ha_entity)
+                ha_data['brightness'] = ha_entity.brightness
+                if ha_data['brightness'] < brightness_value:
+                    ha_data['brightness'] = 10
                 else:
-                    ha_data['brightness'] = light_attrs[0]
-                    if ha_data['brightness'] < brightness_value:
-                        ha_data['brightness'] = 10
-                    else:
-                        ha_data['brightness'] -= brightness_value
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
-                    ha_data['dev_name'] = ha_entity['dev_name']
-                    self.speak_dialog('homeassistant.brightness.decreased',
-                                      data=ha_data)
+                    ha_data['brightness'] -= brightness_value
+                self.speak_dialog('homeassistant.brightness.decreased',
+                                  data=dict(ha_data,
+                                            dev_name=ha_entity.dev_name))
+                self.lights.set_brightness(ha_entity.id,
+                                           ha_data['brightness'],
+                                           self._on_service_error(
+                                               ha_entity.dev_name))
         elif "IncreaseVerb" in message.data or \
                 "LightBrightenVerb" in message.data:
-            if ha_entity['state'] == "off":
-                    self.speak_dialog(
-                        'homeassistant.brightness.cantdim.off',
-                        data=ha_entity)
+            if ha_entity.state == "off":
+                self.speak_dialog('homeassistant.brightness.cantdim.off',
+                                  data={"dev_name": ha_entity.dev_name})
+            elif ha_entity.brightness is None:
+                self.speak_dialog(
+                    'homeassistant.brightness.cantdim.dimmable',
+                    data={"dev_name": ha_entity.dev_name})
             else:
-                light_attrs = self.ha.find_entity_attr(ha_entity['id'])
-                if light_attrs[0] is None:
-                    self.speak_dialog(
-                        'homeassistant.brightness.cantdim.dimmable',
-                        data=ha_entity)
-                else:
-                    ha_data['brightness'] = light_attrs[0]
-                    if ha_data['brightness'] > brightness_value:
-                        ha_data['brightness'] = 255
-                    else:
-                        ha_data['brightness'] += brightness_value
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
-                    ha_data['dev_name'] = ha_entity['dev_name']
-                    self.speak_dialog('homeassistant.brightness.increased',
-                                      data=ha_data)
+                ha_data['brightness'] = min(
+                    ha_entity.brightness + brightness_value, 255)
+                self.speak_dialog('homeassistant.brightness.increased',
+                                  data=dict(ha_data,
+                                            dev_name=ha_entity.dev_name))
+                self.lights.set_brightness(ha_entity.id,
+                                           ha_data['brightness'],
+                                           self._on_service_error(
+                                               ha_entity.dev_name))
         else:
             self.speak_dialog('homeassistant.error.sorry')
             return
 
     @intent_handler(IntentBuilder("AutomationIntent").require(
             "AutomationActionKeyword").require("Entity").build())
+    @timed_intent('automation')
     def handle_automation_intent(self, message):
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            self.speak_dialog('homeassistant.error.offline')
+            return
         entity = message.data["Entity"]
         LOGGER.debug("Entity: %s" % entity)
         # also handle scene and script requests
         try:
-            ha_entity = self.ha.find_entity(
+            ha_entities, missing = self._find_targets(
                 entity, ['automation', 'scene', 'script'])
         except ConnectionError:
             self.speak_dialog('homeassistant.error.offline')
             return
-        ha_data = {'entity_id': ha_entity['id']}
-        if ha_entity is None:
+        if missing:
             self.speak_dialog('homeassistant.device.unknown', data={
-                              "dev_name": entity})
+                              "dev_name": self._join_names(missing)})
+        if not ha_entities:
             return
 
         # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # self.set_context('Entity', ha_entity.dev_name)
 
-        LOGGER.debug("Triggered automation/scene/script: {}".format(ha_data))
-        if "automation" in ha_entity['id']:
-            self.ha.execute_service('automation', 'trigger', ha_data)
-            self.speak_dialog('homeassistant.automation.trigger',
-                              data={"dev_name": ha_entity['dev_name']})
-        elif "script" in ha_entity['id']:
+        automations = [e for e in ha_entities if e.domain == "automation"]
+        scripts = [e for e in ha_entities if e.domain == "script"]
+        scenes = [e for e in ha_entities if e.domain == "scene"]
+        LOGGER.debug("Triggered automation/scene/script: %s" %
+                     [e.id for e in ha_entities])
+        if automations or scripts:
             self.speak_dialog('homeassistant.automation.trigger',
-                              data={"dev_name": ha_entity['dev_name']})
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
-        elif "scene" in ha_entity['id']:
+                              data={"dev_name": self._join_names(
+                                  [e.dev_name for e in automations +
+                                   scripts])})
+        if scenes:
             self.speak_dialog('homeassistant.device.on',
-                              data=ha_entity)
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
+                              data={"dev_name": self._join_names(
+                                  [e.dev_name for e in scenes])})
+        calls = []
+        for domain, service, targets in (
+                ('automation', 'trigger', automations),
+                ("homeassistant", "turn_on", scripts + scenes)):
+            if targets:
+                calls.append(partial(
+                    self.ha.execute_service, domain, service,
+                    {'entity_id': self._entity_ids(targets)},
+                    self._on_service_error(self._join_names(
+                        [e.dev_name for e in targets]))))
+        self._dispatch(calls)
 
     @intent_handler(IntentBuilder("SensorIntent").require(
             "SensorStatusKeyword").require("Entity").build())
+    @timed_intent('sensor')
     def handle_sensor_intent(self, message):
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            self.speak_dialog('homeassistant.error.offline')
+            return
         entity = message.data["Entity"]
         LOGGER.debug("Entity: %s" % entity)
         try:
@@ -462,36 +1549,15 @@ class HomeAssistantSkill(FallbackSkill):
                               "dev_name": entity})
             return
 
-        entity = ha_entity['id']
-
         # IDEA: set context for 'read it out again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
-
-        unit_measurement = self.ha.find_entity_attr(entity)
-        if unit_measurement[0] is not None:
-            sensor_unit = unit_measurement[0]
-        else:
-            sensor_unit = ''
+        # self.set_context('Entity', ha_entity.dev_name)
 
-        sensor_name = unit_measurement[1]
-        sensor_state = unit_measurement[2]
-        # extract unit for correct pronounciation
-        # this is fully optional
-        try:
-            from quantulum import parser
-            quantulumImport = True
-        except ImportError:
-            quantulumImport = False
-
-        if quantulumImport and unit_measurement != '':
-            quantity = parser.parse((u'{} is {} {}'.format(
-                              sensor_name, sensor_state, sensor_unit)))
-            if len(quantity) > 0:
-                quantity = quantity[0]
-                if (quantity.unit.name != "dimensionless" and
-                   quantity.uncertainty <= 0.5):
-                    sensor_unit = quantity.unit.name
-                    sensor_state = quantity.value
+        # the found entity already carries its attributes
+        sensor_name = ha_entity.dev_name
+        sensor_state = ha_entity.state
+        # unit for correct pronounciation
+        with self.metrics.span('units'):
+            sensor_unit = self.units.spoken(ha_entity.unit)
 
         self.speak_dialog('homeassistant.sensor', data={
                       "dev_name": sensor_name,
@@ -509,11 +1575,15 @@ class HomeAssistantSkill(FallbackSkill):
     # - (e.g. "How far is x from y?")
     @intent_handler(IntentBuilder("TrackerIntent").require(
             "DeviceTrackerKeyword").require("Entity").build())
+    @timed_intent('tracker')
     def handle_tracker_intent(self, message):
         self._setup()
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return
+        if not self.ha.available:
+            self.speak_dialog('homeassistant.error.offline')
+            return
         entity = message.data["Entity"]
         LOGGER.debug("Entity: %s" % entity)
         try:
@@ -527,11 +1597,10 @@ class HomeAssistantSkill(FallbackSkill):
             return
 
         # IDEA: set context for 'locate it again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # self.set_context('Entity', ha_entity.dev_name)
 
-        entity = ha_entity['id']
-        dev_name = ha_entity['dev_name']
-        dev_location = ha_entity['state']
+        dev_name = ha_entity.dev_name
+        dev_location = ha_entity.state
         self.speak_dialog('homeassistant.tracker.found',
                           data={'dev_name': dev_name,
                                 'location': dev_location})
@@ -543,16 +1612,39 @@ class HomeAssistantSkill(FallbackSkill):
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return False
+        if not self.ha.available:
+            # leave the utterance to the other fallbacks
+            return False
+        return self._handle_conversation(message)
+
+    @timed_intent('fallback', 'handle_fallback')
+    def _handle_conversation(self, message):
+        """Pass the utterance to the conversation component of HA"""
+        utterance = message.data.get('utterance')
+        if self.screen.known_negative(utterance):
+            return False
+        # don't hold up the other fallbacks with utterances no intent of
+        # the conversation component could match
+        if (self.settings.get('fallback_prescreen') == 'true' and
+                not self.screen.could_match(
+                    utterance, self.components,
+                    self.ha.index if self.ha.index_complete else None)):
+            return False
         # pass message to HA-server
         try:
             response = self.ha.engage_conversation(
-                message.data.get('utterance'))
+                utterance,
+                self._number_setting('fallback_timeout', FALLBACK_TIMEOUT))
         except ConnectionError:
             self.speak_dialog('homeassistant.error.offline')
             return False
+        except Timeout:
+            LOGGER.info('Conversation component did not answer in time')
+            return False
         # default non-parsing answer: "Sorry, I didn't understand that"
         answer = response.get('speech')
         if not answer or answer == "Sorry, I didn't understand that":
+            self.screen.not_understood(utterance)
             return False
 
         asked_question = False
@@ -565,6 +1657,15 @@ class HomeAssistantSkill(FallbackSkill):
 
     def shutdown(self):
         self.remove_fallback(self.handle_fallback)
+        self.lights.close()
+        if self.ha is not None:
+            LOGGER.debug('HA connection stats: %s' %
+                         self.ha.connection_stats())
+            LOGGER.debug('Entity name memo: %s' %
+                         self.ha.index.memo_stats())
+            self.ha.close()
+        if self.capture is not None:
+            self.capture.close()
         super(HomeAssistantSkill, self).shutdown()
 
     def stop(self):
@@ -0,0 +1,94 @@
+"""Entity resolution time of the name index vs. a linear scan
+
+memo_match_ms is the time of a name resolved before (memoized).
+scan_agreement is the share of names the index resolves to the same
+entity as the linear scan (up to --scan-limit entities).
+
+Usage: python benchmarks/bench_entity_index.py [--sizes 100,1000,...]
+"""
+import argparse
+import json
+import sys
+import time
+
+from fuzzywuzzy import fuzz
+
+from population import generate_states, spoken_names
+import skill
+
+Entity = skill.load('entity').Entity
+EntityIndex = skill.load('entity_index').EntityIndex
+
+DOMAINS = ['group', 'light', 'fan', 'switch', 'scene', 'input_boolean']
+# Short names made of the most common words, besides the generated ones
+COMMON_NAMES = ['the light', 'light', 'the lights', 'a switch']
+
+
+def linear_scan(states, entity, types):
+    """The matching find_entity did before there was an index"""
+    best_score = 50
+    best = None
+    for state in states:
+        if state['entity_id'].split(".")[0] in types:
+            for name in (state['attributes']['friendly_name'].lower(),
+                         state['entity_id'].lower()):
+                score = fuzz.token_sort_ratio(entity, name)
+                if score > best_score:
+                    best_score = score
+                    best = state['entity_id']
+    return best
+
+
+def run(sizes, queries, scan_limit):
+    results = []
+    for size in sizes:
+        states = generate_states(size)
+        names = spoken_names(states, queries) + COMMON_NAMES
+        entities = [Entity.from_state(s) for s in states]
+        # no memo, every name is matched
+        index = EntityIndex(memo_size=0)
+        start = time.perf_counter()
+        index.rebuild(entities)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [index.match(name, DOMAINS + ['sensor', 'device_tracker',
+                                              'automation', 'script'])
+                 for name in names]
+        per_match = (time.perf_counter() - start) / len(names)
+        result = {'entities': size, 'build_s': build,
+                  'index_match_ms': per_match * 1000,
+                  'index_hits': sum(1 for f in found if f is not None)}
+        index.memo_size = len(names)
+        matched = [index.match(name, DOMAINS) for name in names]
+        start = time.perf_counter()
+        for name in names:
+            index.match(name, DOMAINS)
+        result['memo_match_ms'] = ((time.perf_counter() - start) /
+                                   len(names) * 1000)
+        if size <= scan_limit:
+            start = time.perf_counter()
+            scanned = [linear_scan(states, name, DOMAINS) for name in names]
+            result['scan_match_ms'] = ((time.perf_counter() - start) /
+                                       len(names) * 1000)
+            result['scan_agreement'] = sum(
+                1 for entity, entity_id in zip(matched, scanned)
+                if (entity and entity.id) == entity_id) / len(names)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,5000,10000,50000')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--scan-limit', type=int, default=5000,
+                        help='largest size to also time the linear scan')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    print(json.dumps(run(sizes, args.queries, args.scan_limit), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Memory held by the cached entity states
+
+Compares the bytes (tracemalloc, after parsing the /api/states payload)
+kept for:
+
+    full        the state dicts as decoded from json
+    projected   state dicts reduced to the attributes the handlers read
+    entities    Entity records grouped by domain (like StateCache)
+    index       the EntityIndex built on top of the records
+
+The generated states carry the attributes a real installation sends
+(icons, device classes, features, ...) besides the ones the skill reads.
+
+Usage: python benchmarks/bench_memory.py [--sizes 10000,50000]
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from population import generate_states
+import skill
+
+Entity = skill.load('entity').Entity
+EntityIndex = skill.load('entity_index').EntityIndex
+
+# Attributes the skill doesn't read, by domain
+EXTRA_ATTRIBUTES = {
+    'light': {'icon': 'mdi:lightbulb', 'supported_features': 41,
+              'min_mireds': 153, 'max_mireds': 500,
+              'effect_list': ['colorloop', 'random']},
+    'switch': {'icon': 'mdi:power-socket-eu', 'assumed_state': False},
+    'sensor': {'device_class': 'temperature',
+               'attribution': 'Data provided by the device'},
+    'device_tracker': {'source_type': 'router', 'icon': 'mdi:cellphone'},
+    'automation': {'last_triggered': '2018-04-02T06:30:00+00:00'},
+}
+
+
+def payload(size):
+    """/api/states body of size entities"""
+    states = generate_states(size)
+    for i, state in enumerate(states):
+        domain = state['entity_id'].split(".")[0]
+        state['attributes'].update(EXTRA_ATTRIBUTES.get(domain, {}))
+        state['context'] = {'id': '%032x' % i, 'user_id': None}
+    return json.dumps(states).encode('utf-8')
+
+
+def projected(states):
+    """State dicts as the skill kept them before the Entity records"""
+    keep = ('friendly_name', 'brightness', 'unit_of_measurement')
+    return [{'entity_id': s['entity_id'], 'state': s['state'],
+             'attributes': dict((k, s['attributes'][k]) for k in keep
+                                if k in s['attributes']),
+             'last_updated': s['last_updated']} for s in states]
+
+
+def entities(states):
+    domains = {}
+    for state in states:
+        entity = Entity.from_state(state)
+        domains.setdefault(entity.domain, {})[entity.id] = entity
+    return domains
+
+
+def measure(build):
+    """Bytes still allocated after build() returned (its result kept)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, result
+
+
+def run(sizes):
+    results = []
+    for size in sizes:
+        body = payload(size)
+        result = {'entities': size}
+        kept, _ = measure(lambda: json.loads(body))
+        result['full_mb'] = kept / 1e6
+        kept, _ = measure(lambda: projected(json.loads(body)))
+        result['projected_mb'] = kept / 1e6
+        kept, domains = measure(lambda: entities(json.loads(body)))
+        result['entities_mb'] = kept / 1e6
+        records = [e for d in domains.values() for e in d.values()]
+        index = EntityIndex()
+        kept, _ = measure(lambda: index.rebuild(records))
+        result['index_mb'] = kept / 1e6
+        result['entities_bytes_per_entity'] = (
+            result['entities_mb'] * 1e6 / size)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='10000,50000')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    print(json.dumps(run(sizes), indent=2))
+
+
+if __name__ == '__main__':
+    main()
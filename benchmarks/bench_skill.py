@@ -0,0 +1,239 @@
+"""Latency of the skill's intent handlers against a fake Home Assistant
+
+Starts benchmarks/fake_server.py with a generated entity population,
+drives every handle_*_intent of HomeAssistantSkill with generated
+messages and reports p50/p95/p99 (ms) per intent and stage as json.
+The stages are the spans the skill records itself (see metrics.py):
+
+    fetch     requests for states (headers only for streamed responses)
+    parse     reading and decoding the states
+    index     updating the entity name index
+    match     resolving the spoken name
+    service   service calls, until the server answered
+    end_to_end    the handler call
+    completed     handler call plus its pending service calls
+
+and any other span of the handlers (e.g. prefetch, units).
+
+Needs mycroft-core (like the skill itself).
+
+Usage: python benchmarks/bench_skill.py --entities 2000 --latency-ms 5
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, wait
+
+from fake_server import FakeHomeAssistant
+from population import DOMAIN_WEIGHTS, generate_states, spoken_names
+import skill
+
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder(object):
+    """Collects stage timings for the intent currently benchmarked"""
+
+    def __init__(self):
+        self.intent = 'setup'
+        self.samples = defaultdict(lambda: defaultdict(list))
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, intent=None):
+        with self._lock:
+            self.samples[intent or self.intent][stage].append(seconds)
+
+    def report(self):
+        results = {}
+        for intent, stages in sorted(self.samples.items()):
+            results[intent] = dict((stage, summarize(values))
+                                   for stage, values in stages.items())
+        return results
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = {'count': len(values),
+               'mean_ms': sum(values) / len(values) * 1000}
+    for p in PERCENTILES:
+        summary['p%d_ms' % p] = percentile(values, p) * 1000
+    return summary
+
+
+def make_skill(module, settings):
+    class BenchmarkSkill(module.HomeAssistantSkill):
+        """The skill with fixed settings and speech going nowhere"""
+
+        def __init__(self):
+            self.spoken = []
+            super(BenchmarkSkill, self).__init__()
+            self.language = 'en-us'
+
+        @property
+        def settings(self):
+            return settings
+
+        @settings.setter
+        def settings(self, value):
+            pass
+
+        def speak_dialog(self, key, data=None, expect_response=False):
+            self.spoken.append(key)
+
+        def speak(self, utterance, expect_response=False):
+            self.spoken.append(utterance)
+
+    return BenchmarkSkill()
+
+
+def instrument(skill_, recorder, pending):
+    """Record the spans of the skill, collect unfinished service calls"""
+    def record(stage, ms):
+        # the handler call is measured as end_to_end
+        if not stage.startswith('intent.'):
+            recorder.record(stage, ms / 1000.0)
+    skill_.metrics.add_listener(record)
+    client = skill_.ha
+    execute_service = client.execute_service
+
+    def collect(*args, **kwargs):
+        result = execute_service(*args, **kwargs)
+        if isinstance(result, Future):
+            pending.append(result)
+        return result
+    client.execute_service = collect
+
+
+def messages(states, rnd):
+    """Message data generators per intent handler"""
+    def names(*domains):
+        subset = [s for s in states
+                  if s['entity_id'].split('.')[0] in domains]
+        return spoken_names(subset, 200, rnd.randint(0, 1 << 30)) or \
+            ['nothing']
+
+    switches = names('light', 'switch', 'fan', 'input_boolean', 'group')
+    lights = names('light')
+    automations = names('automation', 'scene', 'script')
+    sensors = names('sensor')
+    trackers = names('device_tracker')
+    return {
+        'handle_switch_intent': lambda: {
+            'Entity': rnd.choice(switches),
+            'Action': rnd.choice(['on', 'off', 'toggle'])},
+        'handle_light_set_intent': lambda: {
+            'Entity': rnd.choice(lights), 'SetVerb': 'set',
+            'BrightnessValue': str(rnd.randint(0, 100))},
+        'handle_light_adjust_intent': lambda: dict({
+            'Entity': rnd.choice(lights),
+            'BrightnessValue': str(rnd.choice([10, 20, 50]))},
+            **{rnd.choice(['IncreaseVerb', 'DecreaseVerb',
+                           'LightBrightenVerb', 'LightDimVerb']): 'x'}),
+        'handle_automation_intent': lambda: {
+            'Entity': rnd.choice(automations)},
+        'handle_sensor_intent': lambda: {'Entity': rnd.choice(sensors)},
+        'handle_tracker_intent': lambda: {'Entity': rnd.choice(trackers)},
+        'handle_fallback': lambda: {'utterance': rnd.choice([
+            'what is the meaning of life', 'open the pod bay doors',
+            'how tall is the eiffel tower'])},
+    }
+
+
+class Message(object):
+    def __init__(self, data):
+        self.data = data
+
+
+def parse_domains(text):
+    if not text:
+        return DOMAIN_WEIGHTS
+    weights = {}
+    for part in text.split(','):
+        domain, weight = part.split('=')
+        weights[domain.strip()] = float(weight)
+    return weights
+
+
+def run(args):
+    states = generate_states(args.entities, args.seed,
+                             parse_domains(args.domains), args.numbered)
+    fake = FakeHomeAssistant(states, args.latency_ms / 1000.0,
+                             password='benchmark').start()
+    settings = {'host': '127.0.0.1', 'portnum': fake.port,
+                'password': 'benchmark', 'ssl': 'false',
+                'enable_fallback': 'true',
+                'enable_cache': 'true' if args.cache else 'false',
+                'async_services': 'true' if args.async_calls else 'false'}
+    recorder = Recorder()
+    pending = []
+    try:
+        module = skill.load(skill=True)
+        skill_ = make_skill(module, settings)
+        instrument(skill_, recorder, pending)
+        if args.cache and skill_.ha.cache is not None:
+            skill_.ha.cache.wait_synced(30)
+        rnd = random.Random(args.seed)
+        for name, make_data in sorted(messages(states, rnd).items()):
+            handler = getattr(skill_, name)
+            recorder.intent = name
+            for _ in range(args.iterations):
+                start = time.perf_counter()
+                handler(Message(make_data()))
+                recorder.record('end_to_end', time.perf_counter() - start)
+                wait(pending, timeout=30)
+                del pending[:]
+                recorder.record('completed', time.perf_counter() - start)
+        skill_.shutdown()
+    finally:
+        fake.stop()
+    return {'config': {'entities': args.entities,
+                       'latency_ms': args.latency_ms,
+                       'iterations': args.iterations,
+                       'cache': args.cache,
+                       'async': args.async_calls,
+                       'seed': args.seed,
+                       'numbered': args.numbered,
+                       'domains': parse_domains(args.domains)},
+            'server': {'requests': fake.requests,
+                       'bytes_sent': fake.bytes_sent},
+            'results': recorder.report()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--domains', default='',
+                        help='domain mix, e.g. light=20,sensor=40')
+    parser.add_argument('--numbered', type=float, default=0.5,
+                        help='share of names with a device number')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='delay of every server response')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='no websocket state cache')
+    parser.add_argument('--sync', dest='async_calls', action='store_false',
+                        help='wait for service calls in the handlers')
+    parser.add_argument('--output', help='write the json here')
+    args = parser.parse_args()
+    result = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
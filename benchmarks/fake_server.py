@@ -0,0 +1,411 @@
+"""Local stand-in for a Home Assistant server
+
+Serves the REST endpoints the skill uses (/api/states, /api/services,
+/api/components, /api/conversation/process, /api/template) and the
+websocket API (auth, subscribe_events, get_states) from an in-memory
+list of states. Service calls change the states and are pushed as
+state_changed events.
+
+Templates are rendered if jinja2 is installed, else /api/template
+answers 404 like a server without the template API.
+"""
+import base64
+import copy
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+except ImportError:
+    ImmutableSandboxedEnvironment = None
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+NOT_UNDERSTOOD = "Sorry, I didn't understand that"
+
+
+def _now():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+class FakeHomeAssistant(object):
+    """Fake HA server on localhost
+
+    Attributes:
+        states      list of state dicts (see population.generate_states)
+        latency     seconds every response is delayed
+        password    api password the clients have to send (None = any)
+        components  loaded components reported by /api/components
+    """
+
+    def __init__(self, states, latency=0, password=None,
+                 components=('conversation',)):
+        self.latency = latency
+        self.password = password
+        self.components = list(components)
+        self.states = dict((s['entity_id'], copy.deepcopy(s))
+                           for s in states)
+        self.calls = []
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._sockets = []
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        fake = self
+
+        class Handler(RequestHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='FakeHomeAssistant')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        for ws in list(self._sockets):
+            ws.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop_websockets(self):
+        """Close all websocket connections (clients should reconnect)"""
+        for ws in list(self._sockets):
+            ws.close()
+
+    def hang_websockets(self):
+        """Stop answering on the open websocket connections without
+        closing them, like a server that lost power"""
+        for ws in list(self._sockets):
+            ws.hung = True
+
+    def state_list(self):
+        with self._lock:
+            return list(self.states.values())
+
+    def call_service(self, domain, service, data):
+        self.calls.append((domain, service, data))
+        entity_ids = data.get('entity_id', [])
+        if not isinstance(entity_ids, list):
+            entity_ids = [entity_ids]
+        changed = []
+        for entity_id in entity_ids:
+            with self._lock:
+                old = self.states.get(entity_id)
+                if old is None:
+                    continue
+                new = self._apply(old, service, data)
+                self.states[entity_id] = new
+            changed.append(new)
+            self.fire_state_changed(entity_id, old, new)
+        return changed
+
+    def _apply(self, old, service, data):
+        new = copy.deepcopy(old)
+        if service == 'turn_on' or service == 'trigger':
+            new['state'] = 'on'
+        elif service == 'turn_off':
+            new['state'] = 'off'
+        elif service == 'toggle':
+            new['state'] = 'off' if old['state'] == 'on' else 'on'
+        if 'brightness' in data:
+            new['attributes']['brightness'] = data['brightness']
+        elif new['state'] == 'off':
+            new['attributes'].pop('brightness', None)
+        new['last_updated'] = _now()
+        if new['state'] != old['state']:
+            new['last_changed'] = new['last_updated']
+        return new
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Change an entity from outside (like a physical switch would)"""
+        with self._lock:
+            old = self.states.get(entity_id)
+            new = copy.deepcopy(old) if old else {
+                'entity_id': entity_id, 'attributes': {}}
+            new['state'] = state
+            if attributes is not None:
+                new['attributes'] = attributes
+            new['last_updated'] = new['last_changed'] = _now()
+            self.states[entity_id] = new
+        self.fire_state_changed(entity_id, old, new)
+
+    def remove_state(self, entity_id):
+        with self._lock:
+            old = self.states.pop(entity_id, None)
+        self.fire_state_changed(entity_id, old, None)
+
+    def fire_state_changed(self, entity_id, old, new):
+        event = {'event_type': 'state_changed',
+                 'data': {'entity_id': entity_id, 'old_state': old,
+                          'new_state': new},
+                 'time_fired': _now()}
+        for ws in list(self._sockets):
+            ws.send_event('state_changed', event)
+
+
+class _TemplateState(object):
+    """A state as seen by templates (like homeassistant.core.State)"""
+
+    def __init__(self, state):
+        self.entity_id = state['entity_id']
+        self.state = state['state']
+        self.attributes = state['attributes']
+        self.last_updated = datetime.fromisoformat(
+            state.get('last_updated') or _now())
+
+
+class _TemplateStates(object):
+    """The states variable of templates: states.light, states['light']"""
+
+    def __init__(self, states):
+        self._states = states
+
+    def __getattr__(self, domain):
+        prefix = domain + "."
+        return [_TemplateState(s) for entity_id, s
+                in sorted(self._states.items())
+                if entity_id.startswith(prefix)]
+
+    __getitem__ = __getattr__
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_fake = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # like aiohttp: no Nagle delay between headers and body
+        self.connection.setsockopt(socket.IPPROTO_TCP,
+                                   socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def _authorized(self):
+        password = self.server_fake.password
+        return password is None or \
+            self.headers.get('x-ha-access') == password
+
+    def _send(self, code, obj, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(obj).encode('utf-8')
+        else:
+            body = obj.encode('utf-8')
+        if self.server_fake.latency:
+            time.sleep(self.server_fake.latency)
+        self.server_fake.requests += 1
+        self.server_fake.bytes_sent += len(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_GET(self):
+        fake = self.server_fake
+        if self.path == '/api/websocket' and \
+                self.headers.get('Upgrade', '').lower() == 'websocket':
+            return WebSocket(self, fake).serve()
+        if not self._authorized():
+            return self._send(401, {'message': '401: Unauthorized'})
+        if self.path == '/api/states':
+            return self._send(200, fake.state_list())
+        if self.path.startswith('/api/states/'):
+            state = fake.states.get(self.path[len('/api/states/'):])
+            if state is None:
+                return self._send(404, {'message': 'Entity not found.'})
+            return self._send(200, state)
+        if self.path == '/api/components':
+            return self._send(200, fake.components)
+        self._send(404, {'message': 'Not found'})
+
+    def do_POST(self):
+        fake = self.server_fake
+        if not self._authorized():
+            return self._send(401, {'message': '401: Unauthorized'})
+        data = self._read_json()
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 4 and parts[:2] == ['api', 'services']:
+            return self._send(200, fake.call_service(parts[2], parts[3],
+                                                     data))
+        if self.path == '/api/conversation/process':
+            return self._send(200, {'speech': {'plain': {
+                'speech': NOT_UNDERSTOOD, 'extra_data': None}}})
+        if self.path == '/api/template' and ImmutableSandboxedEnvironment:
+            with fake._lock:
+                states = dict(fake.states)
+            try:
+                text = ImmutableSandboxedEnvironment().from_string(
+                    data.get('template', '')).render(
+                        states=_TemplateStates(states))
+            except Exception as e:
+                return self._send(400, 'Error rendering template: %s' % e,
+                                  'text/plain')
+            return self._send(200, text, 'text/plain')
+        self._send(404, {'message': 'Not found'})
+
+
+class WebSocket(object):
+    """Server side of one websocket connection (RFC 6455, text only)"""
+
+    def __init__(self, handler, fake):
+        self.handler = handler
+        self.fake = fake
+        self.subscriptions = []
+        self._write_lock = threading.Lock()
+        self._closed = False
+        # True: nothing is sent anymore (see hang_websockets)
+        self.hung = False
+
+    def serve(self):
+        key = self.handler.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1(
+            (key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+        self.handler.send_response(101, 'Switching Protocols')
+        self.handler.send_header('Upgrade', 'websocket')
+        self.handler.send_header('Connection', 'Upgrade')
+        self.handler.send_header('Sec-WebSocket-Accept', accept)
+        self.handler.end_headers()
+        self.handler.close_connection = True
+        try:
+            self._session()
+        except (IOError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def _session(self):
+        self.send({'type': 'auth_required'})
+        msg = self.recv()
+        password = self.fake.password
+        if password is not None and msg.get('api_password') != password:
+            self.send({'type': 'auth_invalid',
+                       'message': 'Invalid password'})
+            return
+        self.send({'type': 'auth_ok'})
+        self.fake._sockets.append(self)
+        while not self._closed:
+            msg = self.recv()
+            if msg is None:
+                return
+            if msg.get('type') == 'call_service':
+                # like Home Assistant, service calls don't wait for the
+                # commands before them
+                thread = threading.Thread(target=self._command,
+                                          args=(msg,))
+                thread.daemon = True
+                thread.start()
+            else:
+                self._command(msg)
+
+    def _command(self, msg):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if msg['type'] == 'subscribe_events':
+            self.subscriptions.append((msg['id'], msg.get('event_type')))
+            self.send({'id': msg['id'], 'type': 'result', 'success': True,
+                       'result': None})
+        elif msg['type'] == 'get_states':
+            self.send({'id': msg['id'], 'type': 'result', 'success': True,
+                       'result': self.fake.state_list()})
+        elif msg['type'] == 'call_service':
+            self.fake.call_service(msg['domain'], msg['service'],
+                                   msg.get('service_data') or {})
+            self.send({'id': msg['id'], 'type': 'result', 'success': True,
+                       'result': None})
+        elif msg['type'] == 'ping':
+            self.send({'id': msg['id'], 'type': 'pong'})
+        else:
+            self.send({'id': msg['id'], 'type': 'result', 'success': False,
+                       'error': {'code': 'unknown_command',
+                                 'message': 'Unknown command.'}})
+
+    def send_event(self, event_type, event):
+        for sub_id, sub_type in list(self.subscriptions):
+            if sub_type in (None, event_type):
+                self.send({'id': sub_id, 'type': 'event', 'event': event})
+
+    def send(self, msg):
+        if self.hung:
+            return
+        payload = json.dumps(msg).encode('utf-8')
+        self.fake.bytes_sent += len(payload)
+        self._frame(0x1, payload)
+
+    def _frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(length)
+        elif length < 1 << 16:
+            header.append(126)
+            header += struct.pack('!H', length)
+        else:
+            header.append(127)
+            header += struct.pack('!Q', length)
+        with self._write_lock:
+            if self._closed:
+                return
+            try:
+                self.handler.wfile.write(bytes(header) + payload)
+                self.handler.wfile.flush()
+            except (IOError, ValueError):
+                self._closed = True
+
+    def recv(self):
+        """Next text message (as parsed json), None when closed"""
+        rfile = self.handler.rfile
+        while True:
+            head = rfile.read(2)
+            if len(head) < 2:
+                return None
+            opcode = head[0] & 0x0f
+            length = head[1] & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', rfile.read(8))[0]
+            mask = rfile.read(4) if head[1] & 0x80 else None
+            payload = bytearray(rfile.read(length))
+            if mask:
+                for i in range(length):
+                    payload[i] ^= mask[i % 4]
+            if opcode == 0x8:
+                self._frame(0x8, b'')
+                return None
+            if opcode == 0x9:
+                self._frame(0xA, bytes(payload))
+            elif opcode == 0x1:
+                return json.loads(payload.decode('utf-8'))
+
+    def close(self):
+        if self in self.fake._sockets:
+            self.fake._sockets.remove(self)
+        if not self._closed:
+            self._frame(0x8, b'')
+            self._closed = True
+            try:
+                self.handler.connection.shutdown(2)
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,82 @@
+"""Generated Home Assistant entity populations for the benchmarks"""
+import random
+
+ROOMS = ['kitchen', 'living room', 'bedroom', 'bathroom', 'hallway',
+         'office', 'garage', 'garden', 'basement', 'attic', 'porch',
+         'dining room', 'guest room', 'nursery', 'laundry', 'cellar']
+THINGS = {
+    'light': ['light', 'lamp', 'ceiling light', 'spots', 'led strip',
+              'floor lamp', 'reading lamp'],
+    'switch': ['switch', 'socket', 'plug', 'outlet', 'heater'],
+    'sensor': ['temperature', 'humidity', 'power', 'energy', 'pressure',
+               'illuminance', 'battery', 'co2'],
+    'group': ['lights', 'switches', 'all'],
+    'fan': ['fan', 'ventilation'],
+    'input_boolean': ['mode', 'guest mode', 'holiday'],
+    'automation': ['wake up', 'good night', 'motion light'],
+    'scene': ['movie', 'dinner', 'relax'],
+    'script': ['open blinds', 'close blinds'],
+    'device_tracker': ['phone', 'tablet', 'watch'],
+}
+UNITS = {'temperature': u'\xb0C', 'humidity': '%', 'power': 'W',
+         'energy': 'kWh', 'pressure': 'hPa', 'illuminance': 'lx',
+         'battery': '%', 'co2': 'ppm'}
+# domain mix of a typical installation
+DOMAIN_WEIGHTS = {'light': 20, 'switch': 12, 'sensor': 40, 'group': 3,
+                  'fan': 2, 'input_boolean': 3, 'automation': 8,
+                  'scene': 3, 'script': 3, 'device_tracker': 6}
+
+
+def generate_states(count, seed=0, domain_weights=None, numbered=0.5):
+    """List of ``count`` state dicts like /api/states would return them
+
+    Attributes:
+        domain_weights  relative share of each domain (DOMAIN_WEIGHTS)
+        numbered        share of names with a device number appended,
+                        0 gives few distinct names, 1 only unique ones
+    """
+    rnd = random.Random(seed)
+    weights = domain_weights or DOMAIN_WEIGHTS
+    domains = sorted(weights)
+    cum = [weights[d] for d in domains]
+    states = []
+    seen = set()
+    for i in range(count):
+        domain = rnd.choices(domains, cum)[0]
+        thing = rnd.choice(THINGS[domain])
+        name = '%s %s' % (rnd.choice(ROOMS), thing)
+        if name in seen or rnd.random() < numbered:
+            # large installs number their devices
+            name = '%s %d' % (name, i)
+        seen.add(name)
+        entity_id = '%s.%s' % (domain, name.replace(' ', '_'))
+        attributes = {'friendly_name': name.title()}
+        state = 'off'
+        if domain == 'light':
+            state = rnd.choice(['on', 'off'])
+            if state == 'on':
+                attributes['brightness'] = rnd.randint(1, 255)
+        elif domain == 'sensor':
+            state = str(round(rnd.uniform(0, 100), 1))
+            attributes['unit_of_measurement'] = UNITS[thing]
+        elif domain == 'device_tracker':
+            state = rnd.choice(['home', 'not_home', 'work'])
+        elif domain in ('switch', 'fan', 'input_boolean', 'group'):
+            state = rnd.choice(['on', 'off'])
+        states.append({'entity_id': entity_id, 'state': state,
+                       'attributes': attributes,
+                       'last_changed': '2018-04-02T12:00:00+00:00',
+                       'last_updated': '2018-04-02T12:00:00+00:00'})
+    return states
+
+
+def spoken_names(states, count, seed=1):
+    """Names like a user would say them (lower case, words shuffled)"""
+    rnd = random.Random(seed)
+    names = []
+    for state in rnd.sample(states, min(count, len(states))):
+        words = state['attributes']['friendly_name'].lower().split()
+        if rnd.random() < 0.3:
+            rnd.shuffle(words)
+        names.append(' '.join(words))
+    return names
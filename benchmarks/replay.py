@@ -0,0 +1,141 @@
+"""Replay recorded voice sessions against a fake Home Assistant
+
+Reads a trace file written with the "capture_traces" setting (see
+capture.py), serves the entity states each intent saw from
+benchmarks/fake_server.py and calls the same handler with the recorded
+message data. Reports as json:
+
+    results     p50/p95/p99 (ms) per handler of the name resolution
+                (match) and the handler call (end_to_end)
+    agreement   share of intents causing the same service calls and
+                dialogs as when they were recorded
+    mismatches  some of the intents that didn't agree
+
+Run it with the traces of one version to compare the entity resolution
+of another one on real utterances. Service calls a multi server setup
+split over several servers are compared per server, they don't agree
+when replayed against the single fake server.
+
+Needs mycroft-core (like the skill itself).
+
+Usage: python benchmarks/replay.py traces.jsonl --output replay.json
+"""
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+
+from bench_skill import Message, make_skill, summarize
+from fake_server import FakeHomeAssistant
+import skill
+
+# Intents listed in the report that didn't agree
+MISMATCH_SAMPLES = 20
+
+
+def read_traces(path):
+    """(snapshots by id, intents) of a trace file"""
+    snapshots = {}
+    intents = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['type'] == 'snapshot':
+                snapshots[record['id']] = record['states']
+            elif record['type'] == 'intent':
+                intents.append(record)
+    return snapshots, intents
+
+
+def normalized(calls):
+    return sorted(json.dumps(call, sort_keys=True) for call in calls)
+
+
+def run(args):
+    snapshots, intents = read_traces(args.traces)
+    fake = FakeHomeAssistant([], password='replay').start()
+    # every intent fetches the states of its own snapshot
+    settings = {'host': '127.0.0.1', 'portnum': fake.port,
+                'password': 'replay', 'ssl': 'false',
+                'enable_fallback': 'true', 'enable_cache': 'false',
+                'async_services': 'false', 'websocket_services': 'false',
+                'states_freshness': '0'}
+    samples = defaultdict(lambda: defaultdict(list))
+    mismatches = []
+    agreed = 0
+    try:
+        module = skill.load(skill=True)
+        skill_ = make_skill(module, settings)
+        index = skill_.ha.index
+        match = index.match
+        current = {}
+
+        def timed_match(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return match(*args, **kwargs)
+            finally:
+                current['match'] = current.get('match', 0) + \
+                    time.perf_counter() - start
+        index.match = timed_match
+        for intent in intents:
+            states = snapshots.get(intent['snapshot'], [])
+            fake.states = dict((s['entity_id'], s) for s in states)
+            del fake.calls[:]
+            del skill_.spoken[:]
+            current.clear()
+            handler = getattr(skill_, intent['handler'])
+            start = time.perf_counter()
+            handler(Message(intent['data']))
+            elapsed = time.perf_counter() - start
+            # brightness commands still waiting to be sent
+            skill_.lights.close()
+            stages = samples[intent['handler']]
+            stages['end_to_end'].append(elapsed)
+            if 'match' in current:
+                stages['match'].append(current['match'])
+            calls = [list(call) for call in fake.calls]
+            dialogs = [key for key, _ in intent['dialogs']]
+            if (normalized(calls) == normalized(intent['calls']) and
+                    skill_.spoken == dialogs):
+                agreed += 1
+            elif len(mismatches) < MISMATCH_SAMPLES:
+                mismatches.append({
+                    'handler': intent['handler'], 'data': intent['data'],
+                    'recorded': {'calls': intent['calls'],
+                                 'dialogs': dialogs},
+                    'replayed': {'calls': calls,
+                                 'dialogs': list(skill_.spoken)}})
+        skill_.shutdown()
+    finally:
+        fake.stop()
+    results = {}
+    for handler, stages in sorted(samples.items()):
+        results[handler] = dict((stage, summarize(values))
+                                for stage, values in stages.items())
+    return {'config': {'traces': args.traces, 'intents': len(intents),
+                       'snapshots': len(snapshots)},
+            'results': results,
+            'agreement': agreed / float(len(intents)) if intents else None,
+            'mismatches': mismatches}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('traces', help='trace file (traces.jsonl)')
+    parser.add_argument('--output', help='write the json here')
+    args = parser.parse_args()
+    result = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+"""Import the skill directory as a package from the benchmark scripts"""
+import importlib
+import importlib.util
+import os
+import sys
+import types
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'homeassistant_skill'
+
+
+def load(module=None, skill=False):
+    """Import a module of the skill (e.g. 'entity_index')
+
+    Only with skill=True the skill itself (__init__.py) is executed, which
+    needs mycroft-core to be installed.
+    """
+    if PACKAGE not in sys.modules:
+        if skill:
+            spec = importlib.util.spec_from_file_location(
+                PACKAGE, os.path.join(SKILL_DIR, '__init__.py'),
+                submodule_search_locations=[SKILL_DIR])
+            package = importlib.util.module_from_spec(spec)
+            sys.modules[PACKAGE] = package
+            spec.loader.exec_module(package)
+        else:
+            package = types.ModuleType(PACKAGE)
+            package.__path__ = [SKILL_DIR]
+            sys.modules[PACKAGE] = package
+    if module is None:
+        return sys.modules[PACKAGE]
+    return importlib.import_module('%s.%s' % (PACKAGE, module))
@@ -0,0 +1,143 @@
+"""Traces of real voice sessions, to be replayed offline
+
+With trace capture enabled every handled intent is written to a json
+lines file: the message data, the entity states the handler saw and
+the service calls and dialogs it caused. benchmarks/replay.py feeds the
+traces back through the handlers against a local fake server, to
+compare speed and results of the entity resolution across versions.
+
+Lines of the file (by "type"):
+    server      url and headers of the Home Assistant server
+    snapshot    entity states, written when they changed since the last
+                snapshot (id referenced by the intents)
+    intent      handler, message data, snapshot id, service calls,
+                dialogs and timings of one handled intent
+
+Secrets (the x-ha-access token, passwords) are redacted.
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+# Keys whose values are never written
+SECRET_KEYS = ('x-ha-access', 'api_password', 'password')
+REDACTED = '<redacted>'
+
+
+def redact(value, secrets=()):
+    """Copy of value (json data) without secrets"""
+    if isinstance(value, dict):
+        return dict((k, REDACTED if k.lower() in SECRET_KEYS
+                     else redact(v, secrets)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [redact(v, secrets) for v in value]
+    if isinstance(value, str):
+        for secret in secrets:
+            value = value.replace(secret, REDACTED)
+    return value
+
+
+def _fingerprint(entities):
+    return hash(tuple((e.id, e.state, e.name, e.brightness, e.unit)
+                      for e in entities))
+
+
+class TraceRecorder(object):
+    """Writes what the handled intents saw and did to a trace file
+
+    Attributes:
+        open_file   open_file(mode) opens the trace file (e.g. in the
+                    skill's file system)
+        secrets     strings replaced in everything written, e.g. the api
+                    password
+
+    An intent's record stays open until the next intent begins, so
+    service calls sent in the background still belong to it. Its
+    snapshot holds the entities as its lookups saw them, before any of
+    its service calls changed them.
+    """
+
+    def __init__(self, open_file, secrets=()):
+        self.open_file = open_file
+        self.secrets = [s for s in secrets if s]
+        self._record = None
+        # entity id => Entity the open intent looked up (None after end)
+        self._seen = None
+        self._snapshot = None
+        self._snapshots = 0
+        self._lock = threading.Lock()
+
+    def server(self, url, headers):
+        self._write({'type': 'server', 'url': url, 'headers': headers})
+
+    def begin(self, handler, intent, data):
+        """A handler starts handling the message data"""
+        with self._lock:
+            record, self._record = self._record, {
+                'type': 'intent', 'time': time.time(), 'handler': handler,
+                'intent': intent, 'data': data, 'snapshot': None,
+                'calls': [], 'dialogs': []}
+            self._seen = OrderedDict()
+        if record is not None:
+            self._write(record)
+
+    def saw(self, entities):
+        """A lookup of the handler resolved against entities"""
+        with self._lock:
+            if self._seen is None:
+                return
+            for entity in entities:
+                # the first look is the state before the handler's calls
+                if entity.id not in self._seen:
+                    self._seen[entity.id] = entity
+
+    def end(self, trace=None):
+        """The handler returned
+
+        Attributes:
+            trace       metrics.Trace of the handler
+        """
+        with self._lock:
+            entities = list((self._seen or {}).values())
+            self._seen = None
+        fingerprint = _fingerprint(entities)
+        with self._lock:
+            if self._snapshot != fingerprint:
+                self._snapshot = fingerprint
+                self._snapshots += 1
+                snapshot = {'type': 'snapshot', 'id': self._snapshots,
+                            'states': [e.as_state() for e in entities]}
+            else:
+                snapshot = None
+            if self._record is not None:
+                self._record['snapshot'] = self._snapshots
+                if trace is not None:
+                    self._record['timings'] = trace.as_dict()
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def call(self, domain, service, data):
+        """A service call was sent"""
+        with self._lock:
+            if self._record is not None:
+                self._record['calls'].append([domain, service, dict(data)])
+
+    def spoke(self, key, data):
+        """A dialog was spoken"""
+        with self._lock:
+            if self._record is not None:
+                self._record['dialogs'].append([key, dict(data or {})])
+
+    def close(self):
+        """Write the open record"""
+        with self._lock:
+            record, self._record = self._record, None
+        if record is not None:
+            self._write(record)
+
+    def _write(self, line):
+        line = json.dumps(redact(line, self.secrets))
+        with self._lock:
+            with self.open_file('a') as f:
+                f.write(line + '\n')
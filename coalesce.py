@@ -0,0 +1,104 @@
+"""Sharing of fetches between callers asking at the same time
+
+Intents, the fallback and several satellites served by one skill can ask
+for the states of Home Assistant at nearly the same moment. A
+``SingleFlight`` lets the first caller do the request, callers arriving
+while it runs (or shortly after, within ``freshness`` seconds) get the
+same result instead of sending their own.
+"""
+from concurrent.futures import Future
+import threading
+import time
+
+
+def _equal(flight_key, key):
+    return flight_key == key
+
+
+class _Flight(object):
+    __slots__ = ('key', 'future', 'expires')
+
+    def __init__(self, key):
+        self.key = key
+        self.future = Future()
+        # time the result isn't handed out anymore, None while in flight
+        self.expires = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls asking for the same thing
+
+    Attributes:
+        freshness   seconds a result is handed out after it arrived
+        covers      covers(flight_key, key) tells if the result of a
+                    call for flight_key answers a call for key
+    """
+
+    def __init__(self, freshness=0, covers=_equal):
+        self.freshness = freshness
+        self.covers = covers
+        self.calls = 0
+        self.shared = 0
+        self._flights = []
+        self._lock = threading.Lock()
+
+    def do(self, key, func, freshness=None):
+        """Result of func(), or of a running or fresh call covering key
+
+        Attributes:
+            freshness   seconds the result of this call is handed out,
+                        default is self.freshness. A joined call's result
+                        is then handed out at least that long, too.
+        Return:
+            (key of the call that produced the result, result)
+        """
+        with self._lock:
+            self.calls += 1
+            self._expire()
+            # newest first
+            flight = next((f for f in reversed(self._flights)
+                           if self.covers(f.key, key)), None)
+            if flight is None:
+                flight = _Flight(key)
+                self._flights.append(flight)
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+        if not owner:
+            result = flight.future.result()
+            if freshness is not None:
+                self._keep(flight, freshness)
+            return flight.key, result
+        try:
+            result = func()
+        except BaseException as e:
+            self._drop(flight)
+            flight.future.set_exception(e)
+            raise
+        flight.expires = time.time() + (
+            self.freshness if freshness is None else freshness)
+        if result is None:
+            # failures aren't handed out to later callers
+            self._drop(flight)
+        flight.future.set_result(result)
+        return key, result
+
+    def forget(self):
+        """Don't hand out results fetched so far (e.g. after a change)"""
+        with self._lock:
+            self._flights = []
+
+    def _expire(self):
+        now = time.time()
+        self._flights = [f for f in self._flights
+                         if f.expires is None or now <= f.expires]
+
+    def _keep(self, flight, freshness):
+        with self._lock:
+            flight.expires = max(flight.expires, time.time() + freshness)
+
+    def _drop(self, flight):
+        with self._lock:
+            if flight in self._flights:
+                self._flights.remove(flight)
@@ -0,0 +1,104 @@
+"""Screening of utterances before they are sent to Home Assistant
+
+The conversation component of Home Assistant only understands the
+sentences of its intents, everything else gets "Sorry, I didn't
+understand that". Utterances that can't match any of these sentences
+(or name an entity the server doesn't have) are rejected locally, and
+utterances the server didn't understand are remembered for a while.
+
+Remembering is always done. Screening by the sentences only happens
+with the fallback_prescreen setting: it knows just the built-in English
+sentences and would drop custom intents and other languages.
+"""
+from collections import OrderedDict
+import re
+import threading
+import time
+
+from fuzzywuzzy import utils
+
+# Seconds an utterance that wasn't understood is remembered
+NEGATIVE_TTL = 600
+# Number of remembered utterances
+NEGATIVE_SIZE = 256
+
+_ARTICLE = r'(?:(?:the|a|an) )?'
+# Sentences of the intents of the conversation component, by the
+# component that has to be loaded (None: always there)
+INTENTS = {
+    None: [
+        r'^turn %s(?P<name>.+?) (?:on|off)$' % _ARTICLE,
+        r'^turn (?:on|off) %s(?P<name>.+)$' % _ARTICLE,
+        r'^toggle %s(?P<name>.+)$' % _ARTICLE,
+    ],
+    'shopping_list': [
+        r'^add (?P<item>.+) to my shopping list$',
+        r'^what is on my shopping list$',
+    ],
+}
+_INTENTS = dict((component, [re.compile(p) for p in patterns])
+                for component, patterns in INTENTS.items())
+
+
+def normalize(utterance):
+    return utils.full_process(utterance or '', force_ascii=True)
+
+
+class ConversationScreen(object):
+    """Decides which utterances are worth asking the server about"""
+
+    def __init__(self, ttl=NEGATIVE_TTL, size=NEGATIVE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+
+    def could_match(self, utterance, components, index=None):
+        """Check if the conversation component could understand utterance
+
+        Attributes:
+            utterance   the raw utterance
+            components  components loaded at the server
+            index       EntityIndex of all entities, None if the names
+                        aren't known (then any name is accepted)
+        """
+        text = normalize(utterance)
+        for component, patterns in _INTENTS.items():
+            if component is not None and component not in components:
+                continue
+            for pattern in patterns:
+                match = pattern.match(text)
+                if match is None:
+                    continue
+                name = match.groupdict().get('name')
+                if name is None or index is None or \
+                        self._names_entity(index, name):
+                    return True
+        return False
+
+    @staticmethod
+    def _names_entity(index, name):
+        domains = index.domains()
+        # the conversation component accepts plurals ("turn on lights")
+        return (index.match(name, domains) is not None or
+                (name.endswith('s') and
+                 index.match(name[:-1], domains) is not None))
+
+    def not_understood(self, utterance):
+        """Remember an utterance the server didn't understand"""
+        with self._lock:
+            self._negative[normalize(utterance)] = time.time() + self.ttl
+            while len(self._negative) > self.size:
+                self._negative.popitem(last=False)
+
+    def known_negative(self, utterance):
+        """Check if the server didn't understand utterance recently"""
+        text = normalize(utterance)
+        with self._lock:
+            expires = self._negative.get(text)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._negative[text]
+                return False
+            return True
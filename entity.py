@@ -0,0 +1,76 @@
+"""Records of Home Assistant entities as used by the intent handlers
+
+A large installation has tens of thousands of entities, each with a
+dozen attributes no handler reads. Records keep only the attributes
+below as plain fields, and the domain and state strings are interned so
+the thousands of "sensor"s and "on"s are stored once.
+"""
+from sys import intern
+
+# The attributes read by the handlers (by field name), all others are
+# dropped
+ATTRIBUTES = (('name', 'friendly_name'),
+              ('brightness', 'brightness'),
+              ('unit', 'unit_of_measurement'))
+
+
+class Entity(object):
+    """One entity state of the Home Assistant server
+
+    Attributes:
+        id              entity id, e.g. light.kitchen
+        domain          part of the id before the dot, e.g. light
+        state           state string, e.g. on
+        name            friendly name, None if the entity has none
+        brightness      brightness (0..255) of lights, None if not
+                        dimmable or off
+        unit            unit of measurement of sensors
+        last_updated    time of the state as sent by the server
+    """
+    __slots__ = ('id', 'domain', 'state', 'name', 'brightness', 'unit',
+                 'last_updated')
+
+    def __init__(self, entity_id, state, name=None, brightness=None,
+                 unit=None, last_updated=None):
+        self.id = entity_id
+        self.domain = intern(entity_id.partition(".")[0])
+        self.state = intern(state) if isinstance(state, str) else state
+        self.name = name
+        self.brightness = brightness
+        self.unit = unit
+        self.last_updated = last_updated
+
+    @classmethod
+    def from_state(cls, state):
+        """Create the record of a state dict (/api/states format)"""
+        attributes = state.get('attributes') or {}
+        return cls(state['entity_id'], state['state'],
+                   last_updated=state.get('last_updated'),
+                   **dict((field, attributes.get(key))
+                          for field, key in ATTRIBUTES))
+
+    def as_state(self):
+        """The record as state dict (/api/states format)"""
+        state = {'entity_id': self.id,
+                 'state': self.state,
+                 'attributes': dict(
+                     (key, getattr(self, field))
+                     for field, key in ATTRIBUTES
+                     if getattr(self, field) is not None)}
+        if self.last_updated is not None:
+            state['last_updated'] = self.last_updated
+        return state
+
+    def replace(self, **fields):
+        """Copy of the record with the given fields changed"""
+        entity = Entity.__new__(Entity)
+        for slot in self.__slots__:
+            setattr(entity, slot, fields.get(slot, getattr(self, slot)))
+        return entity
+
+    @property
+    def dev_name(self):
+        return self.id if self.name is None else self.name
+
+    def __repr__(self):
+        return 'Entity(%r, %r)' % (self.id, self.state)
@@ -0,0 +1,319 @@
+"""Name index for matching spoken names to Home Assistant entities
+
+Names are normalized and token-sorted once when an entity is added, so
+scoring a candidate is a plain ``fuzz.ratio`` (the same value
+``fuzz.token_sort_ratio`` would return). A per-domain trigram index
+narrows the candidates down to the entities sharing parts of the name.
+They are tried most shared trigrams first, and a candidate is only
+scored if an upper bound of its score (from the lengths and letters of
+the names) could still beat the best one so far.
+
+Resolved names are memoized. A memoized match stays valid as long as no
+entity of the searched domains was added, removed or renamed, state
+changes don't matter.
+
+The index holds the Entity records it was given, indexed by domain.
+"""
+from collections import Counter, OrderedDict, defaultdict
+import threading
+
+from fuzzywuzzy import fuzz, utils
+
+# Only entities scoring above this are considered a match
+MIN_SCORE = 50
+# Trigrams shared by more entities of a domain than this are skipped
+# (like "sen" of "sensor") as long as rarer trigrams already produced
+# candidates of the domain
+MAX_POSTING = 256
+# Number of resolved (spoken name, domains) pairs kept
+MEMO_SIZE = 256
+
+
+def sort_tokens(name):
+    """Normalize a name the way fuzz.token_sort_ratio does"""
+    tokens = utils.full_process(name, force_ascii=True).split()
+    return u" ".join(sorted(tokens))
+
+
+def trigrams(sorted_name):
+    grams = set()
+    for token in sorted_name.split():
+        token = u" %s " % token
+        for i in range(len(token) - 2):
+            grams.add(token[i:i + 3])
+    return grams
+
+
+def score_bound(query, query_letters, name):
+    """Upper bound of fuzz.ratio(query, name)
+
+    Like SequenceMatcher.quick_ratio: no more letters can match than
+    both names have in common.
+
+    Attributes:
+        query_letters   Counter of the letters of query
+    """
+    total = len(query) + len(name)
+    if not total:
+        return 0
+    common = sum(min(count, name.count(letter))
+                 for letter, count in query_letters.items())
+    return utils.intr(200.0 * common / total)
+
+
+def _entry_grams(entry):
+    """Trigrams of all indexed names of entry"""
+    return set().union(*(trigrams(name) for name in entry.names))
+
+
+def _known_names(entry, entity):
+    """Indexed names of entry if entity wasn't renamed, else None"""
+    if entry is not None and entry.entity.name == entity.name:
+        return entry.names
+    return None
+
+
+class IndexEntry(object):
+    __slots__ = ('entity', 'names', 'order')
+
+    def __init__(self, entity, order, names=None):
+        self.entity = entity
+        # scored in this order, friendly name first (like before)
+        self.names = names or (sort_tokens(entity.name),
+                               sort_tokens(entity.id))
+        self.order = order
+
+
+class EntityIndex(object):
+    """Searchable snapshot of the entities of a Home Assistant server
+
+    Build it with ``rebuild`` from a full list of Entity records and keep
+    it current with ``update``/``remove``, or ``replace`` the entities
+    of some domains with a newer snapshot of them.
+    """
+
+    def __init__(self, memo_size=MEMO_SIZE):
+        self._lock = threading.Lock()
+        self._clear()
+        # (query, domains, min_score) => (fingerprints, entity id or None)
+        self._memo = OrderedDict()
+        self.memo_size = memo_size
+        self.hits = 0
+        self.misses = 0
+
+    def _clear(self):
+        self._entries = {}
+        # domain => ids of its entities
+        self._domains = defaultdict(set)
+        # domain => trigram => entity ids (lists, most trigrams belong to
+        # a single entity and a set would take four times the memory)
+        self._grams = defaultdict(lambda: defaultdict(list))
+        # domain => xor of the hashes of its (entity id, names), changes
+        # only if an entity is added, removed or renamed
+        self._fingerprints = defaultdict(int)
+        self._order = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def rebuild(self, entities):
+        with self._lock:
+            old = self._entries
+            self._clear()
+            for entity in entities:
+                # names of known entities don't have to be processed again
+                self._add(entity, names=_known_names(old.get(entity.id),
+                                                     entity))
+
+    def replace(self, entities, types):
+        """Index entities instead of the entities of the domains types
+
+        The other domains stay as they are, so lookups of other domains
+        running at the same time still find their entities.
+        """
+        entities = [e for e in entities if e.name is not None]
+        with self._lock:
+            if self._same_names(entities, types):
+                # only states changed (the usual case), the postings stay
+                for entity in entities:
+                    entry = self._entries[entity.id]
+                    self._entries[entity.id] = IndexEntry(
+                        entity, entry.order, entry.names)
+                return
+            old = {}
+            for domain in set(types):
+                # dropped as a whole, removing the ids one by one from
+                # the postings would take time quadratic in their size
+                for entity_id in self._domains.pop(domain, ()):
+                    old[entity_id] = self._entries.pop(entity_id)
+                self._grams.pop(domain, None)
+                self._fingerprints.pop(domain, None)
+            for entity in entities:
+                entry = old.get(entity.id)
+                self._add(entity, None if entry is None else entry.order,
+                          _known_names(entry, entity))
+
+    def _same_names(self, entities, types):
+        """Whether entities are the indexed ones of the domains types,
+        none of them renamed"""
+        if len(entities) != sum(len(self._domains.get(domain, ()))
+                                for domain in set(types)):
+            return False
+        return all(_known_names(self._entries.get(entity.id), entity)
+                   is not None and entity.domain in types
+                   for entity in entities)
+
+    def update(self, entity):
+        with self._lock:
+            old = self._entries.get(entity.id)
+            names = _known_names(old, entity)
+            if names is not None:
+                # only the state changed, the names stay indexed
+                self._entries[entity.id] = IndexEntry(entity, old.order,
+                                                      names)
+                return
+            old = self._remove(entity.id)
+            self._add(entity, None if old is None else old.order)
+
+    def remove(self, entity_id):
+        with self._lock:
+            self._remove(entity_id)
+
+    def _add(self, entity, order=None, names=None):
+        if entity.name is None:
+            # entities without a name can't be asked for
+            return
+        if order is None:
+            order = self._order
+            self._order += 1
+        try:
+            entry = IndexEntry(entity, order, names)
+        except TypeError:
+            return
+        self._entries[entity.id] = entry
+        self._domains[entity.domain].add(entity.id)
+        self._fingerprints[entity.domain] ^= hash((entity.id, entry.names))
+        domain_grams = self._grams[entity.domain]
+        for gram in _entry_grams(entry):
+            domain_grams[gram].append(entity.id)
+
+    def _remove(self, entity_id):
+        entry = self._entries.pop(entity_id, None)
+        if entry is None:
+            return None
+        self._domains[entry.entity.domain].discard(entity_id)
+        domain_grams = self._grams[entry.entity.domain]
+        self._fingerprints[entry.entity.domain] ^= hash((entity_id,
+                                                         entry.names))
+        for gram in _entry_grams(entry):
+            ids = domain_grams.get(gram)
+            if ids is not None and entity_id in ids:
+                ids.remove(entity_id)
+                if not ids:
+                    del domain_grams[gram]
+        return entry
+
+    def domains(self):
+        """Domains of the indexed entities"""
+        with self._lock:
+            return [domain for domain, ids in self._domains.items() if ids]
+
+    def entities(self, types):
+        """All entities of the given domains, in the order of the states"""
+        with self._lock:
+            entries = [self._entries[i] for domain in set(types)
+                       for i in self._domains.get(domain, ())]
+        entries.sort(key=lambda e: e.order)
+        return [e.entity for e in entries]
+
+    def match(self, entity, types, min_score=MIN_SCORE):
+        """Best matching entity of the given domains
+
+        Attributes:
+            entity      spoken name of the entity
+            types       list of allowed domains
+        Return:
+            Entity or None if nothing scored above min_score
+        """
+        query = sort_tokens(entity)
+        if not query:
+            return None
+        domains = tuple(sorted(set(types)))
+        key = (query, domains, min_score)
+        with self._lock:
+            fingerprints = tuple(self._fingerprints.get(d, 0)
+                                 for d in domains)
+            memo = self._memo.get(key)
+            if memo is not None and memo[0] == fingerprints:
+                self.hits += 1
+                self._memo.move_to_end(key)
+                entity_id = memo[1]
+                # the entry holds the current state of the entity
+                return (None if entity_id is None
+                        else self._entries[entity_id].entity)
+            self.misses += 1
+            best_entry = self._best(query, domains, min_score)
+            self._memo[key] = (fingerprints, None if best_entry is None
+                               else best_entry.entity.id)
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+            if best_entry is None:
+                return None
+            return best_entry.entity
+
+    def memo_stats(self):
+        """Size and hit rate of the memoized matches"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._memo),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups
+                    else 0.0}
+
+    def _best(self, query, types, min_score):
+        """Entry with the best score above min_score (the first one in
+        the order of the states if several score the same) or None"""
+        letters = Counter(query)
+        best_score = min_score
+        best_entry = None
+        for entry in self._candidates(query, types):
+            # an entry after the best one has to score higher
+            limit = best_score
+            if best_entry is not None and entry.order < best_entry.order:
+                limit -= 1
+            for name in entry.names:
+                if 200 * min(len(query), len(name)) <= \
+                        limit * (len(query) + len(name)) or \
+                        score_bound(query, letters, name) <= limit:
+                    continue
+                score = fuzz.ratio(query, name)
+                if score > limit:
+                    best_score = limit = score
+                    best_entry = entry
+        return best_entry
+
+    def _candidates(self, query, types):
+        grams = trigrams(query)
+        hits = defaultdict(int)
+        for domain in set(types):
+            domain_grams = self._grams.get(domain)
+            if domain_grams is None:
+                continue
+            # rare trigrams first, they say the most about the name
+            postings = sorted((domain_grams[gram] for gram in grams
+                               if gram in domain_grams), key=len)
+            # per domain, a small domain mustn't rule out the common
+            # trigrams of a large one
+            found = False
+            for ids in postings:
+                if len(ids) > MAX_POSTING and found:
+                    break
+                for entity_id in ids:
+                    hits[entity_id] += 1
+                found = True
+        # most shared trigrams first, the best score rises early and
+        # rules out more of the others
+        return [self._entries[i]
+                for i in sorted(hits, key=hits.get, reverse=True)]
@@ -0,0 +1,69 @@
+"""Reachability of the Home Assistant server
+
+Once a connection to the server failed it is considered down: requests
+fail right away instead of each waiting for its timeout, while a
+background thread probes the server (with backoff) until it answers.
+"""
+import threading
+
+from mycroft.util.log import getLogger
+
+LOGGER = getLogger(__name__)
+
+# Delays between probes of a down server (seconds), last one is repeated
+PROBE_DELAYS = [1, 2, 5, 10, 30]
+
+
+class CircuitBreaker(object):
+    """Tracks if the server can be reached
+
+    Attributes:
+        probe       callable returning True if the server answers
+        delays      seconds between probes while the server is down
+    """
+
+    def __init__(self, probe, delays=PROBE_DELAYS):
+        self.probe = probe
+        self.delays = delays
+        self.trips = 0
+        self._down = threading.Event()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def available(self):
+        """False while the server is known to be unreachable"""
+        return not self._down.is_set()
+
+    def success(self):
+        if self._down.is_set():
+            LOGGER.info('Home Assistant is reachable again')
+            self._down.clear()
+
+    def failure(self, error=None):
+        """A connection failed, stop sending requests until a probe works"""
+        with self._lock:
+            if self._down.is_set() or self._closed.is_set():
+                return
+            LOGGER.warning('Home Assistant unreachable: %s' % error)
+            self.trips += 1
+            self._down.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='HomeAssistantProbe')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def close(self):
+        self._closed.set()
+
+    def _run(self):
+        attempt = 0
+        while self._down.is_set():
+            delay = self.delays[min(attempt, len(self.delays) - 1)]
+            attempt += 1
+            if self._closed.wait(delay):
+                return
+            if self.probe():
+                self.success()
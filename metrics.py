@@ -0,0 +1,118 @@
+"""Timing of the hot paths of the skill
+
+Code measures a stage with ``metrics.span('fetch')``. The duration goes
+into a rolling histogram per stage and, if the current thread is
+handling an intent (``metrics.trace('switch')``), into that intent's
+trace, together with counters like the number of entities and bytes
+transferred. Listeners (e.g. benchmarks/bench_skill.py) get every span,
+also those of service calls run in the background.
+"""
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+# Number of samples kept per stage
+WINDOW = 500
+PERCENTILES = (50, 95, 99)
+
+
+class Trace(object):
+    """Spans and counters of one intent"""
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.counters = {}
+        self.total = None
+
+    def count(self, key, value):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def as_dict(self):
+        return {'intent': self.name,
+                'total_ms': self.total,
+                'spans': [{'stage': stage, 'ms': ms}
+                          for stage, ms in self.spans],
+                'counters': dict(self.counters)}
+
+    def __str__(self):
+        parts = ['%s=%.1fms' % span for span in self.spans]
+        parts += ['%s=%s' % item for item in sorted(self.counters.items())]
+        return '%s: total=%.1fms %s' % (self.name, self.total or 0,
+                                        ' '.join(parts))
+
+
+class Metrics(object):
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(stage, ms) with every recorded span"""
+        self._listeners.append(listener)
+
+    @property
+    def current(self):
+        """Trace of the intent handled by this thread (or None)"""
+        return getattr(self._local, 'trace', None)
+
+    def record(self, stage, ms):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = deque(
+                    maxlen=self.window)
+            histogram.append(ms)
+        trace = self.current
+        if trace is not None:
+            trace.spans.append((stage, ms))
+        for listener in self._listeners:
+            listener(stage, ms)
+
+    def count(self, key, value):
+        trace = self.current
+        if trace is not None:
+            trace.count(key, value)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.time() - start) * 1000)
+
+    @contextmanager
+    def trace(self, name):
+        """Collect the spans of an intent handled by the current thread"""
+        trace = Trace(name)
+        outer = self.current
+        self._local.trace = trace
+        start = time.time()
+        try:
+            yield trace
+        finally:
+            self._local.trace = outer
+            trace.total = (time.time() - start) * 1000
+            self.record('intent.%s' % name, trace.total)
+
+    def summary(self):
+        """Percentiles (ms) of the kept samples of every stage"""
+        with self._lock:
+            histograms = dict((stage, sorted(values)) for stage, values
+                              in self._histograms.items())
+        summary = {}
+        for stage, values in histograms.items():
+            if not values:
+                continue
+            stats = {'count': len(values),
+                     'mean_ms': sum(values) / len(values)}
+            for p in PERCENTILES:
+                rank = min(int(p / 100.0 * len(values)), len(values) - 1)
+                stats['p%d_ms' % p] = values[rank]
+            summary[stage] = stats
+        return summary
@@ -0,0 +1,186 @@
+"""Several Home Assistant servers seen as one
+
+The entities of all servers go into one index. Entity ids of the
+additional servers are tagged with the name of their server,
+``light.kitchen@garage``, so they stay unique, keep their domain and
+the server name can be said ("garage kitchen light"). The first server
+is the primary one, its ids aren't tagged.
+"""
+from concurrent.futures import Future
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+# Seconds to wait for the states of a server before going on without
+SERVER_TIMEOUT = 3
+
+
+def tag(entity_id, origin):
+    """Entity id as used in the merged index"""
+    if origin is None:
+        return entity_id
+    return "%s@%s" % (entity_id, origin)
+
+
+def untag(entity_id):
+    """(entity id at its server, server name or None)"""
+    entity_id, _, origin = entity_id.partition("@")
+    return entity_id, origin or None
+
+
+def tag_entity(entity, origin):
+    if origin is None or entity is None:
+        return entity
+    return entity.replace(id=tag(entity.id, origin))
+
+
+def parse_servers(text):
+    """Additional servers of the settings
+
+    Attributes:
+        text    "name=http[s]://password@host:port[?timeout=s]" entries
+                separated by ";" (or new lines)
+    Return:
+        list of dicts with name, host, port, password, ssl and timeout
+    """
+    servers = []
+    for entry in (text or '').replace('\n', ';').split(';'):
+        if not entry.strip():
+            continue
+        name, _, url = entry.partition('=')
+        parts = urlsplit(url.strip())
+        if not name.strip() or not parts.hostname:
+            raise ValueError('Invalid server definition: %s' % entry)
+        query = parse_qs(parts.query)
+        servers.append({
+            'name': name.strip().lower().replace(' ', '_'),
+            'host': parts.hostname,
+            'port': parts.port,
+            'password': parts.password or parts.username,
+            'ssl': parts.scheme == 'https',
+            'timeout': float(query.get('timeout', [SERVER_TIMEOUT])[0])})
+    return servers
+
+
+def combine(results):
+    """One result for the execute_service results of several servers
+
+    Return:
+        True if all calls were accepted, or a Future of that if a call
+        is still running (AsyncHomeAssistantClient)
+    """
+    futures = [r for r in results if isinstance(r, Future)]
+    if not futures:
+        return all(results)
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        combined.set_result(all(r.result() if isinstance(r, Future) else r
+                                for r in results))
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+class _TaggingListener(object):
+    """Passes the changes of one server's cache on with tagged ids"""
+
+    def __init__(self, caches, origin, listener):
+        self.caches = caches
+        self.origin = origin
+        self.listener = listener
+
+    def rebuild(self, entities):
+        # the listener knows all servers, give it all of them again
+        self.listener.rebuild(self.caches.states())
+
+    def update(self, entity):
+        self.listener.update(tag_entity(entity, self.origin))
+
+    def remove(self, entity_id):
+        self.listener.remove(tag(entity_id, self.origin))
+
+
+class _TaggingCapture(object):
+    """Notes the service calls of one server with tagged ids"""
+
+    def __init__(self, capture, origin):
+        self.capture = capture
+        self.origin = origin
+
+    def call(self, domain, service, data):
+        entity_ids = data.get('entity_id')
+        if entity_ids is not None:
+            if isinstance(entity_ids, list):
+                entity_ids = [tag(i, self.origin) for i in entity_ids]
+            else:
+                entity_ids = tag(entity_ids, self.origin)
+            data = dict(data, entity_id=entity_ids)
+        self.capture.call(domain, service, data)
+
+    def saw(self, entities):
+        self.capture.saw([tag_entity(e, self.origin) for e in entities])
+
+
+def tagging_capture(capture, origin):
+    """TraceRecorder of the calls of a server (see capture.py)"""
+    if capture is None or origin is None:
+        return capture
+    return _TaggingCapture(capture, origin)
+
+
+class MultiStateCache(object):
+    """The StateCaches of several servers as one (see StateCache)
+
+    Attributes:
+        caches      list of (server name or None, StateCache)
+    """
+
+    def __init__(self, caches):
+        self.caches = caches
+        self._by_origin = dict(caches)
+
+    @property
+    def synced(self):
+        return all(cache.synced for _, cache in self.caches)
+
+    def start(self):
+        for _, cache in self.caches:
+            cache.start()
+
+    def stop(self):
+        for _, cache in self.caches:
+            cache.stop()
+
+    def add_listener(self, listener):
+        for origin, cache in self.caches:
+            cache.add_listener(_TaggingListener(self, origin, listener))
+
+    def wait_synced(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for _, cache in self.caches:
+            remaining = (None if deadline is None
+                         else max(deadline - time.time(), 0))
+            if not cache.wait_synced(remaining):
+                return False
+        return True
+
+    def states(self, types=None):
+        entities = []
+        for origin, cache in self.caches:
+            entities.extend(tag_entity(e, origin)
+                            for e in cache.states(types))
+        return entities
+
+    def get(self, entity_id):
+        entity_id, origin = untag(entity_id)
+        cache = self._by_origin.get(origin)
+        if cache is None:
+            return None
+        return tag_entity(cache.get(entity_id), origin)
@@ -0,0 +1,172 @@
+"""Predicted state of lights with commands in flight
+
+Home Assistant reports the new brightness of a light only after its
+transition finished, so "brighter ... brighter" read the same old value
+twice and one step got lost. The tracker remembers what the skill asked
+for and uses it as the state of the light until the server reports it
+(or HOLD seconds passed). Brightness changes following each other within
+WINDOW seconds are sent as one service call.
+"""
+import threading
+import time
+
+# Seconds within which brightness changes are sent as one call
+WINDOW = 0.5
+# Seconds a prediction is used if the server doesn't confirm it
+HOLD = 5
+
+
+class _Prediction(object):
+    __slots__ = ('state', 'brightness', 'time', 'sent', 'timer', 'on_error')
+
+    def __init__(self):
+        self.state = None
+        # None: unknown, keep what the server said
+        self.brightness = None
+        self.time = 0
+        self.sent = 0
+        self.timer = None
+        self.on_error = None
+
+
+class LightTracker(object):
+    """Optimistic on/off and brightness of lights
+
+    Attributes:
+        send        send(entity_id, service_data, on_error) calls
+                    homeassistant.turn_on
+        window      seconds brightness changes are coalesced
+        hold        seconds a prediction is kept without confirmation
+
+    Add it as listener of the StateCache to drop predictions as soon as
+    the server confirms them.
+    """
+
+    def __init__(self, send, window=WINDOW, hold=HOLD):
+        self.send = send
+        self.window = window
+        self.hold = hold
+        self.coalesced = 0
+        self._predictions = {}
+        self._lock = threading.Lock()
+
+    def predict(self, entity):
+        """The entity as it will be once the pending commands are done"""
+        with self._lock:
+            prediction = self._predictions.get(entity.id)
+            if prediction is None:
+                return entity
+            if (prediction.timer is None and
+                    time.time() - prediction.time > self.hold):
+                del self._predictions[entity.id]
+                return entity
+            if prediction.state == 'off':
+                brightness = None
+            elif prediction.brightness is not None:
+                brightness = prediction.brightness
+            else:
+                brightness = entity.brightness
+            return entity.replace(state=prediction.state,
+                                  brightness=brightness)
+
+    def expect(self, entity_id, state, brightness=None):
+        """Remember a command sent by the caller itself"""
+        with self._lock:
+            prediction = self._prediction(entity_id)
+            if prediction.timer is not None:
+                # the newer command wins over a pending change
+                prediction.timer.cancel()
+                prediction.timer = None
+            prediction.state = state
+            prediction.brightness = brightness
+            prediction.time = prediction.sent = time.time()
+
+    def set_brightness(self, entity_id, brightness, on_error=None):
+        """Change the brightness, coalesced with changes following it
+
+        The first change is sent right away, changes arriving within
+        the next WINDOW seconds only once the window is over (with the
+        last brightness asked for).
+        """
+        with self._lock:
+            prediction = self._prediction(entity_id)
+            now = time.time()
+            prediction.state = 'on'
+            prediction.brightness = brightness
+            prediction.time = now
+            prediction.on_error = on_error
+            if prediction.timer is not None:
+                self.coalesced += 1
+                return
+            wait = prediction.sent + self.window - now
+            if wait > 0:
+                prediction.timer = threading.Timer(wait, self._flush,
+                                                   (entity_id,))
+                prediction.timer.daemon = True
+                prediction.timer.start()
+                return
+            prediction.sent = now
+        self._send(entity_id, brightness, on_error)
+
+    def _prediction(self, entity_id):
+        prediction = self._predictions.get(entity_id)
+        if prediction is None:
+            prediction = self._predictions[entity_id] = _Prediction()
+        return prediction
+
+    def _flush(self, entity_id):
+        with self._lock:
+            prediction = self._predictions.get(entity_id)
+            if prediction is None or prediction.timer is None:
+                return
+            prediction.timer = None
+            prediction.sent = time.time()
+            brightness = prediction.brightness
+            on_error = prediction.on_error
+        self._send(entity_id, brightness, on_error)
+
+    def _send(self, entity_id, brightness, on_error):
+        def failed(error):
+            # the light stays as the server says
+            self.remove(entity_id)
+            if on_error is not None:
+                on_error(error)
+        self.send(entity_id, {'entity_id': entity_id,
+                              'brightness': brightness}, failed)
+
+    def close(self):
+        """Forget all predictions, pending changes are sent right away"""
+        with self._lock:
+            pending = []
+            for entity_id, prediction in self._predictions.items():
+                if prediction.timer is not None:
+                    prediction.timer.cancel()
+                    pending.append((entity_id, prediction.brightness,
+                                    prediction.on_error))
+            self._predictions = {}
+        for entity_id, brightness, on_error in pending:
+            self._send(entity_id, brightness, on_error)
+
+    # StateCache listener
+
+    def rebuild(self, entities):
+        for entity in entities:
+            if entity.id in self._predictions:
+                self.update(entity)
+
+    def update(self, entity):
+        with self._lock:
+            prediction = self._predictions.get(entity.id)
+            if prediction is None or prediction.timer is not None:
+                return
+            if entity.state == prediction.state and (
+                    prediction.state == 'off' or
+                    prediction.brightness in (None, entity.brightness)):
+                # the server caught up
+                del self._predictions[entity.id]
+
+    def remove(self, entity_id):
+        with self._lock:
+            prediction = self._predictions.pop(entity_id, None)
+            if prediction is not None and prediction.timer is not None:
+                prediction.timer.cancel()
@@ -0,0 +1,151 @@
+"""Entity states of some domains, rendered by the server
+
+/api/states sends every entity with all its attributes, megabytes on a
+large installation, although the sensor or tracker intents only look at
+a few domains. The template API (POST /api/template) can instead render
+just the fields of an Entity for the wanted domains, one json list per
+line, which is kilobytes.
+
+Rendering a template costs the server more time per entity than sending
+the cached states, so neither way is always faster. ``FetchPlanner``
+measures both and picks the cheaper one per set of domains.
+"""
+import json
+import threading
+
+from .entity import ATTRIBUTES, Entity
+
+# Weight of the newest measurement in the running averages
+SMOOTHING = 0.3
+# Every EXPLORE_EVERY fetches the other way is measured again
+EXPLORE_EVERY = 20
+# The smaller projection is taken as long as it is at most this much slower
+TOLERANCE = 1.2
+
+
+def template(types):
+    """Template rendering the entities of the domains types
+
+    Every line is the json list [entity_id, state, <ATTRIBUTES>,
+    last_updated].
+    """
+    fields = ["s.entity_id", "s.state"] + [
+        "s.attributes.get(%s)" % json.dumps(key) for _, key in ATTRIBUTES
+    ] + ["s.last_updated.isoformat()"]
+    return ("{%% for domain in %s %%}{%% for s in states[domain] %%}"
+            "{{ [%s] | tojson }}\n{%% endfor %%}{%% endfor %%}" %
+            (json.dumps(sorted(types)), ", ".join(fields)))
+
+
+def parse(text):
+    """Entity records of a rendered template
+
+    Raises:
+        ValueError if the text isn't what template() renders
+    """
+    entities = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        values = json.loads(line)
+        if not isinstance(values, list) or \
+                len(values) != len(ATTRIBUTES) + 3:
+            raise ValueError('Unexpected template line %r' % line[:80])
+        entities.append(Entity(
+            values[0], values[1], last_updated=values[-1],
+            **dict((field, value) for (field, _), value
+                   in zip(ATTRIBUTES, values[2:-1]))))
+    return entities
+
+
+class _Cost(object):
+    """Running averages of the seconds and bytes of one way to fetch"""
+    __slots__ = ('seconds', 'size')
+
+    def __init__(self, seconds, size):
+        self.seconds = seconds
+        self.size = size
+
+    def add(self, seconds, size):
+        self.seconds += SMOOTHING * (seconds - self.seconds)
+        self.size += SMOOTHING * (size - self.size)
+
+
+class FetchPlanner(object):
+    """Chooses between /api/states and the template projection
+
+    The full fetch is measured once for all domains, the projection per
+    set of domains. A projection not measured yet is tried, afterwards
+    the one that was faster is used (the projection also when it was
+    only a little slower, but smaller). Every EXPLORE_EVERY fetches the
+    other way is taken to follow changes of the server.
+    """
+
+    def __init__(self):
+        # False once the server rendered no projection (e.g. older
+        # versions without the tojson filter)
+        self.supported = True
+        self.full_fetches = 0
+        self.template_fetches = 0
+        self._full = None
+        # frozenset of domains => _Cost
+        self._templates = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def use_template(self, types):
+        """Whether the states of the domains types are best projected"""
+        if types is None or not self.supported:
+            return False
+        with self._lock:
+            self._count += 1
+            explore = self._count % EXPLORE_EVERY == 0
+            projected = self._templates.get(frozenset(types))
+            full = self._full
+        if projected is None:
+            return True
+        if full is None:
+            return not explore
+        if projected.size < full.size:
+            cheaper = projected.seconds <= full.seconds * TOLERANCE
+        else:
+            cheaper = projected.seconds < full.seconds
+        return cheaper != explore
+
+    def record(self, types, seconds, size):
+        """A fetch took seconds and size bytes
+
+        Attributes:
+            types       domains of a projection, None for the full fetch
+        """
+        with self._lock:
+            if types is None:
+                self.full_fetches += 1
+                cost = self._full
+            else:
+                self.template_fetches += 1
+                types = frozenset(types)
+                cost = self._templates.get(types)
+            if cost is not None:
+                cost.add(seconds, size)
+            elif types is None:
+                self._full = _Cost(seconds, size)
+            else:
+                self._templates[types] = _Cost(seconds, size)
+
+    def unsupported(self):
+        self.supported = False
+
+    def stats(self):
+        """Fetches and average seconds and bytes per way"""
+        with self._lock:
+            costs = [('full', self._full)] + [
+                (",".join(sorted(types)), cost)
+                for types, cost in self._templates.items()]
+            return {'full_fetches': self.full_fetches,
+                    'template_fetches': self.template_fetches,
+                    'template_supported': self.supported,
+                    'costs': dict((name, {'ms': cost.seconds * 1000,
+                                          'bytes': int(cost.size)})
+                                  for name, cost in costs
+                                  if cost is not None)}
@@ -0,0 +1,199 @@
+"""Service calls over the Home Assistant websocket API
+
+One authenticated connection carries all service calls. A command is
+sent without waiting for the ones before it (pipelined) and its result
+is matched by the message id, so several calls can be in flight at once
+and each one learns whether the server accepted it. Compared to a REST
+POST per call there is no request overhead once the connection is up.
+
+A call without a result after RESULT_TIMEOUT seconds fails, and a quiet
+connection is pinged like the one of the state cache, so calls on a
+connection the server silently lost don't wait forever.
+"""
+from concurrent.futures import Future
+from functools import partial
+import json
+import threading
+
+from mycroft.util.log import getLogger
+from requests.exceptions import ConnectionError, RequestException
+
+from .state_cache import (PING_INTERVAL, connect, receive_alive,
+                          websocket)
+
+LOGGER = getLogger(__name__)
+
+# Seconds a call waits for its result (Home Assistant answers after at
+# most 10, even if the service is still running)
+RESULT_TIMEOUT = 15
+
+
+class ServiceError(RequestException):
+    """The server refused a service call (e.g. unknown service)"""
+
+
+def _fail(lost):
+    for future, error in lost:
+        future.set_exception(ConnectionError(error))
+
+
+class ServiceSocket(object):
+    """Websocket connection sending call_service commands
+
+    Attributes:
+        url         websocket endpoint, e.g. ws://hass:8123/api/websocket
+        password    api password of the server (may be None)
+        sslopt      options passed to websocket.create_connection
+        timeout     seconds to connect and to wait for an answer to a ping
+        result_timeout  seconds a call waits for its result
+        ping_interval   seconds without a message before a ping
+
+    The connection is opened by the first call and opened again by the
+    next call after it was lost.
+    """
+
+    def __init__(self, url, password, sslopt=None, timeout=10,
+                 result_timeout=RESULT_TIMEOUT, ping_interval=PING_INTERVAL):
+        self.url = url
+        self.password = password
+        self.sslopt = sslopt or {}
+        self.timeout = timeout
+        self.result_timeout = result_timeout
+        self.ping_interval = ping_interval
+        self.calls = 0
+        self._ws = None
+        self._msg_id = 0
+        # message id => Future of the result
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @staticmethod
+    def available():
+        """Check if the websocket client library is installed"""
+        return websocket is not None
+
+    def call(self, domain, service, data):
+        """Send a call_service command
+
+        Return:
+            Future of True once the server accepted the call, failing
+            with ServiceError if it refused and ConnectionError if the
+            connection was lost or no result came within result_timeout
+        """
+        future = Future()
+        # calls of a lost connection, failed once the lock is released
+        lost = []
+        error = None
+        with self._lock:
+            if self._closed:
+                error = 'connection closed'
+            else:
+                self._msg_id += 1
+                message = json.dumps({'id': self._msg_id,
+                                      'type': 'call_service',
+                                      'domain': domain, 'service': service,
+                                      'service_data': data})
+                try:
+                    self._send(message, lost)
+                except Exception as e:
+                    error = e
+                else:
+                    # the reader needs the lock to look the result up
+                    self._pending[self._msg_id] = future
+                    self.calls += 1
+                    timer = threading.Timer(self.result_timeout,
+                                            self._expire, (self._msg_id,))
+                    timer.daemon = True
+                    timer.start()
+                    future.add_done_callback(lambda f: timer.cancel())
+        _fail(lost)
+        if error is not None:
+            future.set_exception(ConnectionError(error))
+        return future
+
+    def _expire(self, msg_id):
+        with self._lock:
+            future = self._pending.pop(msg_id, None)
+        if future is not None:
+            future.set_exception(ConnectionError(
+                'no result within %ds' % self.result_timeout))
+
+    def _send(self, message, lost):
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.send(message)
+                return
+            except Exception as e:
+                # the server went away while the connection was idle
+                LOGGER.debug('Service connection lost: %s' % e)
+                lost.extend(self._drop(ws, e))
+        ws = self._ws = connect(self.url, self.password, self.sslopt,
+                                self.timeout)
+        reader = threading.Thread(target=self._read, args=(ws,),
+                                  name='HomeAssistantServiceSocket')
+        reader.daemon = True
+        reader.start()
+        ws.send(message)
+
+    def _read(self, ws):
+        try:
+            while True:
+                # results come whenever the server is done, a quiet
+                # connection is pinged instead of timing out
+                msg = receive_alive(ws, partial(self._ping, ws),
+                                    self.ping_interval, self.timeout)
+                if msg.get('type') != 'result':
+                    continue
+                with self._lock:
+                    future = self._pending.pop(msg.get('id'), None)
+                if future is None:
+                    continue
+                if msg.get('success'):
+                    future.set_result(True)
+                else:
+                    error = msg.get('error') or {}
+                    future.set_exception(ServiceError(
+                        '%s: %s' % (error.get('code'),
+                                    error.get('message'))))
+        except Exception as e:
+            with self._lock:
+                lost = self._drop(ws, e)
+            _fail(lost)
+
+    def _ping(self, ws):
+        with self._lock:
+            self._msg_id += 1
+            ws.send(json.dumps({'id': self._msg_id, 'type': 'ping'}))
+
+    def _drop(self, ws, error):
+        """Forget the connection ws (lock held)
+
+        Return:
+            list of (Future, error) of its calls, to be failed after the
+            lock is released (their callbacks may send new calls)
+        """
+        lost = []
+        if self._ws is ws:
+            self._ws = None
+            pending, self._pending = self._pending, {}
+            lost = [(future, error) for future in pending.values()]
+        try:
+            ws.close()
+        except Exception:
+            pass
+        return lost
+
+    def pending(self):
+        """Number of calls waiting for their result"""
+        with self._lock:
+            return len(self._pending)
+
+    def close(self):
+        lost = []
+        with self._lock:
+            self._closed = True
+            if self._ws is not None:
+                lost = self._drop(self._ws, 'connection closed')
+        _fail(lost)
@@ -0,0 +1,292 @@
+"""Live copy of the Home Assistant entity states
+
+The cache is filled once by a bulk ``get_states`` and afterwards kept
+current by the ``state_changed`` events of the Home Assistant websocket
+API. On disconnect it reconnects (with backoff) and resyncs. States are
+kept as Entity records, grouped by domain.
+
+A quiet connection is pinged, so a server that went away without
+closing it (power loss, router reboot) is noticed too.
+"""
+import json
+import threading
+
+from mycroft.util.log import getLogger
+
+from .entity import Entity
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+LOGGER = getLogger(__name__)
+
+# Delays between reconnection attempts (seconds), last one is repeated
+RECONNECT_DELAYS = [1, 2, 5, 10, 30]
+# Seconds without a message after which the server is pinged
+PING_INTERVAL = 30
+# Seconds the server has to answer a ping
+PONG_TIMEOUT = 10
+
+
+def connect(url, password, sslopt=None, timeout=10):
+    """Open an authenticated connection to the Home Assistant websocket API
+
+    Attributes:
+        url         websocket endpoint, e.g. ws://hass:8123/api/websocket
+        password    api password of the server (may be None)
+        sslopt      options passed to websocket.create_connection
+    """
+    ws = websocket.create_connection(url, timeout=timeout,
+                                     sslopt=sslopt or {})
+    try:
+        msg = receive(ws)
+        if msg.get('type') == 'auth_required':
+            ws.send(json.dumps({'type': 'auth', 'api_password': password}))
+            msg = receive(ws)
+        if msg.get('type') != 'auth_ok':
+            raise ValueError('authentication failed: %s' %
+                             msg.get('message', msg.get('type')))
+    except BaseException:
+        ws.close()
+        raise
+    return ws
+
+
+def receive(ws):
+    """Next message of the websocket connection ws"""
+    data = ws.recv()
+    if not data:
+        raise IOError('connection closed by server')
+    return json.loads(data)
+
+
+def receive_alive(ws, ping, interval=PING_INTERVAL, timeout=PONG_TIMEOUT):
+    """Next message of ws, pinging the server while the connection is quiet
+
+    Attributes:
+        ping        ping() sends a ping command, the answer (pong) is
+                    returned like any other message
+    Raises:
+        IOError if the server didn't answer the ping within timeout
+    """
+    ws.settimeout(interval)
+    try:
+        return receive(ws)
+    except websocket.WebSocketTimeoutException:
+        pass
+    ping()
+    ws.settimeout(timeout)
+    try:
+        return receive(ws)
+    except websocket.WebSocketTimeoutException:
+        raise IOError('no answer to a ping within %ds' % timeout)
+
+
+class StateCache(object):
+    """Entity states of a Home Assistant server, updated in the background
+
+    Attributes:
+        url         websocket endpoint, e.g. ws://hass:8123/api/websocket
+        password    api password of the server (may be None)
+        sslopt      options passed to websocket.create_connection
+        timeout     seconds to connect and to wait for an answer to a ping
+        ping_interval   seconds without a message before a ping
+    """
+
+    def __init__(self, url, password, sslopt=None, timeout=10,
+                 ping_interval=PING_INTERVAL):
+        self.url = url
+        self.password = password
+        self.sslopt = sslopt or {}
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        # domain => entity id => Entity
+        self._domains = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._ws = None
+        self._msg_id = 0
+        self._snapshot_id = None
+        self._listeners = []
+
+    @staticmethod
+    def available():
+        """Check if the websocket client library is installed"""
+        return websocket is not None
+
+    @property
+    def synced(self):
+        """True while the cache mirrors the server state"""
+        return self._synced.is_set()
+
+    def start(self):
+        if not self.available():
+            LOGGER.warning('websocket-client not installed, '
+                           'no live entity cache')
+            return
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='HomeAssistantStateCache')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._synced.clear()
+        self._close()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join(self.timeout)
+        self._thread = None
+
+    def add_listener(self, listener):
+        """Get notified about every change of the cached states
+
+        The listener needs the methods rebuild(entities) (called after
+        each sync), update(entity) and remove(entity_id).
+        """
+        self._listeners.append(listener)
+
+    def wait_synced(self, timeout=None):
+        return self._synced.wait(timeout)
+
+    def states(self, types=None):
+        """List of the cached Entity records
+
+        Attributes:
+            types       list of domains to return, None for all
+        """
+        with self._lock:
+            if types is None:
+                domains = list(self._domains.values())
+            else:
+                domains = [self._domains[d] for d in types
+                           if d in self._domains]
+            return [e for entities in domains for e in entities.values()]
+
+    def get(self, entity_id):
+        with self._lock:
+            entities = self._domains.get(entity_id.partition(".")[0])
+            return None if entities is None else entities.get(entity_id)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(e) for e in self._domains.values())
+
+    def _run(self):
+        attempt = 0
+        while not self._stopped.is_set():
+            try:
+                self._connect()
+                attempt = 0
+                self._listen()
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                LOGGER.warning('Home Assistant websocket lost: %s' % e)
+            finally:
+                self._synced.clear()
+                self._close()
+            delay = RECONNECT_DELAYS[min(attempt,
+                                         len(RECONNECT_DELAYS) - 1)]
+            attempt += 1
+            self._stopped.wait(delay)
+
+    def _connect(self):
+        self._ws = connect(self.url, self.password, self.sslopt,
+                           self.timeout)
+        # subscribe before fetching the snapshot so no change gets lost
+        self._send_command({'type': 'subscribe_events',
+                            'event_type': 'state_changed'})
+        self._snapshot_id = self._send_command({'type': 'get_states'})
+
+    def _listen(self):
+        pending = []
+        while not self._stopped.is_set():
+            msg = self._recv()
+            if msg.get('type') == 'event':
+                if self.synced:
+                    self._apply_event(msg['event'])
+                else:
+                    # replayed once the snapshot arrived
+                    pending.append(msg['event'])
+            elif (msg.get('type') == 'result' and
+                    msg.get('id') == self._snapshot_id):
+                if not msg.get('success'):
+                    raise ValueError('get_states failed: %s' %
+                                     msg.get('error'))
+                domains = {}
+                for state in msg['result']:
+                    entity = Entity.from_state(state)
+                    domains.setdefault(entity.domain, {})[entity.id] = entity
+                with self._lock:
+                    self._domains = domains
+                for event in pending:
+                    self._apply_event(event, replayed=True)
+                pending = []
+                states = self.states()
+                for listener in self._listeners:
+                    listener.rebuild(states)
+                self._synced.set()
+                LOGGER.debug('Entity cache synced (%d entities)' %
+                             len(states))
+
+    def _apply_event(self, event, replayed=False):
+        data = event.get('data', {})
+        entity_id = data.get('entity_id')
+        if entity_id is None:
+            return
+        new_state = data.get('new_state')
+        if new_state is not None:
+            # keep only what the handlers need
+            new_state = Entity.from_state(new_state)
+        domain = entity_id.partition(".")[0]
+        with self._lock:
+            entities = self._domains.get(domain)
+            current = None if entities is None else entities.get(entity_id)
+            if (replayed and new_state is not None and current is not None and
+                    (new_state.last_updated or '') <
+                    (current.last_updated or '')):
+                # the snapshot is already newer than this event
+                return
+            if new_state is None:
+                # entity was removed
+                if current is not None:
+                    del entities[entity_id]
+            else:
+                self._domains.setdefault(domain, {})[entity_id] = new_state
+        if replayed:
+            # listeners get the whole snapshot afterwards
+            return
+        for listener in self._listeners:
+            if new_state is None:
+                listener.remove(entity_id)
+            else:
+                listener.update(new_state)
+
+    def _send_command(self, command):
+        self._msg_id += 1
+        command['id'] = self._msg_id
+        self._ws.send(json.dumps(command))
+        return self._msg_id
+
+    def _recv(self):
+        # events are only sent when something happens, a quiet
+        # connection is pinged instead of timing out
+        return receive_alive(
+            self._ws, lambda: self._send_command({'type': 'ping'}),
+            self.ping_interval, self.timeout)
+
+    def _close(self):
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
@@ -0,0 +1,64 @@
+"""Incremental parsing of large json responses
+
+/api/states of a big installation is several MB, mostly attributes the
+skill never reads. Parsing it element by element keeps only one state
+dict in memory at a time instead of the whole list.
+"""
+from itertools import chain
+import codecs
+import json
+import re
+
+# Bytes read from the response at once
+CHUNK_SIZE = 64 * 1024
+
+_SEPARATORS = re.compile(r'[\s,]*')
+_decoder = json.JSONDecoder()
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a json array arriving in chunks of bytes
+
+    Attributes:
+        chunks      iterable of bytes, e.g. response.iter_content()
+    """
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = 0
+    started = False
+    # retry an incomplete element only after the buffer doubled, so big
+    # elements aren't parsed again for every chunk
+    retry_at = 0
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            # end of data, whatever is left has to parse now
+            buf = buf[pos:] + text.decode(b'', final=True)
+            retry_at = 0
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+            retry_at -= pos
+        pos = 0
+        if len(buf) < retry_at:
+            continue
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('json array expected')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete, wait for more data
+                retry_at = pos + 2 * (len(buf) - pos)
+                break
+            retry_at = 0
+            pos = end
+            yield element
+    raise ValueError('unexpected end of json array')
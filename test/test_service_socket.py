@@ -0,0 +1,68 @@
+"""ServiceSocket against the fake Home Assistant of the benchmarks
+
+Needs mycroft-core (like the skill itself) and websocket-client.
+
+Usage: python -m pytest test
+"""
+import os
+import sys
+import time
+import unittest
+
+from requests.exceptions import ConnectionError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_server import FakeHomeAssistant  # noqa: E402
+import skill  # noqa: E402
+
+service_socket = skill.load('service_socket')
+
+
+class ServiceSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeHomeAssistant(
+            [{'entity_id': 'light.kitchen', 'state': 'off',
+              'attributes': {'friendly_name': 'Kitchen Light'},
+              'last_updated': '2018-04-02T12:00:00.000000+00:00'}],
+            password='secret').start()
+        self.socket = service_socket.ServiceSocket(
+            'ws://127.0.0.1:%d/api/websocket' % self.fake.port, 'secret',
+            timeout=1, result_timeout=1, ping_interval=0.3)
+
+    def tearDown(self):
+        self.socket.close()
+        self.fake.stop()
+
+    def call(self):
+        return self.socket.call('light', 'turn_on',
+                                {'entity_id': 'light.kitchen'})
+
+    def test_result(self):
+        self.assertTrue(self.call().result(2))
+        self.assertEqual(self.fake.calls[-1][:2], ('light', 'turn_on'))
+        self.assertEqual(self.socket.pending(), 0)
+
+    def test_no_result(self):
+        self.call().result(2)
+        # the server stops answering without closing the connection
+        self.fake.hang_websockets()
+        future = self.call()
+        with self.assertRaises(ConnectionError):
+            future.result(3)
+        self.assertEqual(self.socket.pending(), 0)
+
+    def test_reconnect_after_silent_loss(self):
+        self.call().result(2)
+        self.fake.hang_websockets()
+        # the unanswered ping drops the connection
+        end = time.time() + 3
+        while self.socket._ws is not None and time.time() < end:
+            time.sleep(0.05)
+        self.assertIsNone(self.socket._ws)
+        self.assertTrue(self.call().result(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""StateCache against the fake Home Assistant of the benchmarks
+
+Needs mycroft-core (like the skill itself) and websocket-client.
+
+Usage: python -m pytest test
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+from fake_server import FakeHomeAssistant  # noqa: E402
+import skill  # noqa: E402
+
+state_cache = skill.load('state_cache')
+
+
+def state(entity_id, value, name):
+    return {'entity_id': entity_id, 'state': value,
+            'attributes': {'friendly_name': name},
+            'last_updated': '2018-04-02T12:00:00.000000+00:00'}
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+class Listener(object):
+    def __init__(self):
+        self.rebuilds = 0
+        self.updated = []
+        self.removed = []
+
+    def rebuild(self, entities):
+        self.rebuilds += 1
+
+    def update(self, entity):
+        self.updated.append(entity.id)
+
+    def remove(self, entity_id):
+        self.removed.append(entity_id)
+
+
+class StateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeHomeAssistant(
+            [state('light.kitchen', 'off', 'Kitchen Light'),
+             state('sensor.outside', '12', 'Outside Temperature')],
+            password='secret').start()
+        self.cache = state_cache.StateCache(
+            'ws://127.0.0.1:%d/api/websocket' % self.fake.port, 'secret',
+            timeout=1, ping_interval=0.3)
+        self.listener = Listener()
+        self.cache.add_listener(self.listener)
+        self.cache.start()
+        self.assertTrue(self.cache.wait_synced(5))
+
+    def tearDown(self):
+        self.cache.stop()
+        self.fake.stop()
+
+    def test_sync(self):
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('light.kitchen').state, 'off')
+        self.assertEqual([e.id for e in self.cache.states(['sensor'])],
+                         ['sensor.outside'])
+        self.assertEqual(self.listener.rebuilds, 1)
+
+    def test_event(self):
+        self.fake.set_state('light.kitchen', 'on')
+        self.assertTrue(wait_for(
+            lambda: self.cache.get('light.kitchen').state == 'on'))
+        self.assertEqual(self.listener.updated, ['light.kitchen'])
+
+    def test_new_entity(self):
+        self.fake.set_state('fan.ceiling', 'on', {'friendly_name': 'Fan'})
+        self.assertTrue(wait_for(
+            lambda: self.cache.get('fan.ceiling') is not None))
+        self.assertEqual(self.cache.get('fan.ceiling').name, 'Fan')
+
+    def test_removal(self):
+        self.fake.remove_state('sensor.outside')
+        self.assertTrue(wait_for(
+            lambda: self.cache.get('sensor.outside') is None))
+        self.assertEqual(self.listener.removed, ['sensor.outside'])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_resync_after_drop(self):
+        self.fake.drop_websockets()
+        self.assertTrue(wait_for(lambda: not self.cache.synced, 2))
+        # changed while no events were received
+        self.fake.set_state('light.kitchen', 'on')
+        self.assertTrue(self.cache.wait_synced(5))
+        self.assertTrue(wait_for(
+            lambda: self.cache.get('light.kitchen').state == 'on'))
+        self.assertEqual(self.listener.rebuilds, 2)
+
+    def test_resync_after_silent_loss(self):
+        # the server stops answering without closing the connection
+        self.fake.hang_websockets()
+        self.assertTrue(wait_for(lambda: not self.cache.synced, 3))
+        self.assertTrue(self.cache.wait_synced(5))
+        self.fake.set_state('light.kitchen', 'on')
+        self.assertTrue(wait_for(
+            lambda: self.cache.get('light.kitchen').state == 'on'))
+
+
+if __name__ == '__main__':
+    unittest.main()
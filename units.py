@@ -0,0 +1,94 @@
+"""Pronunciation of the units of sensor values
+
+Most sensors report one of a few units, their spoken names are known.
+Other units are looked up with quantulum (optional, slow to load), the
+result is memoized per unit string.
+"""
+from collections import OrderedDict
+import threading
+
+from mycroft.util.log import getLogger
+
+LOGGER = getLogger(__name__)
+
+# Spoken names (as quantulum names them) of common sensor units
+KNOWN_UNITS = {
+    u'°C': 'degree Celsius',
+    u'°F': 'degree Fahrenheit',
+    u'%': 'percentage',
+    u'W': 'watt',
+    u'kW': 'kilowatt',
+    u'kWh': 'kilowatt hour',
+    u'V': 'volt',
+    u'A': 'ampere',
+    u'lx': 'lux',
+    u'hPa': 'hectopascal',
+    u'km/h': 'kilometre per hour',
+    u'm/s': 'metre per second',
+    u'mm': 'millimetre',
+    u'ppm': 'part per million',
+}
+# Number of memoized unit strings
+CACHE_SIZE = 64
+
+
+class UnitSpeaker(object):
+    """Resolves unit strings to the names to be spoken"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        # None: not loaded yet, False: quantulum isn't installed
+        self._parser = None
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def warm(self):
+        """Load quantulum in the background"""
+        thread = threading.Thread(target=self._load, name='QuantulumLoader')
+        thread.daemon = True
+        thread.start()
+
+    def _load(self):
+        with self._load_lock:
+            if self._parser is None:
+                try:
+                    from quantulum import parser
+                except ImportError:
+                    LOGGER.debug('quantulum not installed, units are '
+                                 'spoken as reported')
+                    parser = False
+                self._parser = parser
+        return self._parser
+
+    def spoken(self, unit):
+        """Name of unit to be spoken, the unit itself if it isn't known"""
+        if not unit:
+            return ''
+        name = KNOWN_UNITS.get(unit)
+        if name is not None:
+            return name
+        with self._lock:
+            name = self._memo.get(unit)
+            if name is not None:
+                self._memo.move_to_end(unit)
+                return name
+        name = self._parse(unit)
+        with self._lock:
+            self._memo[unit] = name
+            while len(self._memo) > self.size:
+                self._memo.popitem(last=False)
+        return name
+
+    def _parse(self, unit):
+        parser = self._load()
+        if not parser:
+            return unit
+        quantities = parser.parse(u'1 %s' % unit)
+        if quantities:
+            quantity = quantities[0]
+            if (quantity.unit.name != "dimensionless" and
+                    (quantity.uncertainty is None or
+                     quantity.uncertainty <= 0.5)):
+                return quantity.unit.name
+        return unit